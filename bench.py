@@ -0,0 +1,220 @@
+"""Offline render benchmark for create_ppt's rendering path.
+
+Feeds synthetic slide JSON straight to render_ppt_sync / render_slide, so no OpenAI, fal.ai
+or Telegram calls are made. Covers every registry template, deck sizes from 4 to 60 slides and
+every layout (title, introduction, conclusion and each LAYOUT_TYPES entry).
+
+    python bench.py                                 # run and compare against bench_baseline.json
+    python bench.py --update-baseline               # record the current numbers as the new baseline
+    python bench.py --update-baseline --portable    # record only shapes and bytes (the committed baseline)
+
+Exits with status 1 when a metric regresses past the allowed tolerance or the baseline is missing.
+Shapes and bytes are deterministic, so the committed baseline holds only those; timings and
+memory depend on the machine and belong in a local baseline.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import contextlib
+import io
+import tracemalloc
+
+# main.py builds an OpenAI client at import time; it is never called here
+os.environ.setdefault("OPENAI_API_KEY", "offline-benchmark")
+
+import main
+from pptx import Presentation
+
+DECK_SIZES = [4, 10, 20, 40, 60]
+PORTABLE_METRICS = ("shapes", "bytes")
+
+SAMPLE_SLIDES = {
+    "title": {
+        "type": "title",
+        "title": "Sun'iy intellekt va ta'lim",
+        "university": "Toshkent axborot texnologiyalari universiteti",
+        "student": "Aliyev Vali",
+        "from_to": "Karimov A.A.",
+    },
+    "introduction": {
+        "type": "introduction",
+        "title": "Kirish va Reja",
+        "content": "Sun'iy intellekt ta'lim jarayonini shaxsiylashtirish va o'qituvchilar ishini yengillashtirish imkonini beradi.",
+        "outline": ["Asosiy tushunchalar", "Qo'llanilish sohalari", "Afzalliklar va xavflar", "Kelajak istiqbollari"],
+    },
+    "conclusion": {
+        "type": "conclusion",
+        "title": "Xulosa",
+        "summary": "Sun'iy intellekt ta'limni yanada samarali qiladi, ammo undan mas'uliyat bilan foydalanish kerak.",
+        "takeaways": ["Shaxsiy yondashuv", "Tezkor baholash", "Axloqiy nazorat"],
+    },
+}
+
+def content_slide(i):
+    return {
+        "type": "content",
+        "title": f"Asosiy bo'lim {i + 1}",
+        "points": [
+            "Talabalar uchun moslashuvchan o'quv rejalari yaratiladi",
+            "O'qituvchilar vaqtini tejaydigan avtomatik baholash tizimlari",
+            "Katta ma'lumotlar asosida o'zlashtirish tahlili olib boriladi",
+            "Virtual yordamchilar kun davomida savollarga javob beradi",
+        ],
+    }
+
+def synthetic_deck(size):
+    content_slides = [content_slide(i) for i in range(size - 3)]
+    return [SAMPLE_SLIDES["title"], SAMPLE_SLIDES["introduction"]] + content_slides + [SAMPLE_SLIDES["conclusion"]]
+
+def fresh(content):
+    # render_slide pads "points" in place, so every run gets its own copy
+    return json.loads(json.dumps(content))
+
+def count_shapes(ppt_bytes):
+    prs = Presentation(io.BytesIO(ppt_bytes))
+    return sum(len(slide.shapes) for slide in prs.slides)
+
+def bench_deck(template, size, repeat):
+    content = synthetic_deck(size)
+    timings = []
+    for _ in range(repeat):
+        deck = fresh(content)
+        random.seed(size)
+        start = time.perf_counter()
+        ppt_bytes = main.render_ppt_sync(deck, template["name"])
+        timings.append(time.perf_counter() - start)
+
+    deck = fresh(content)
+    random.seed(size)
+    tracemalloc.start()
+    main.render_ppt_sync(deck, template["name"])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = min(timings)
+    return {
+        "ms": round(best * 1000, 2),
+        "ms_per_slide": round(best * 1000 / size, 3),
+        "peak_kb": round(peak / 1024, 1),
+        "shapes": count_shapes(ppt_bytes),
+        "bytes": len(ppt_bytes),
+    }
+
+def render_layout_slide(prs, template, layout):
+    if layout in SAMPLE_SLIDES:
+        return main.render_slide(prs, template, 0, fresh(SAMPLE_SLIDES[layout]), [])
+    slide_obj = prs.slides.add_slide(prs.slide_layouts[6])
+    slide_data = content_slide(0)
+    if main.PROTOTYPE_SLIDES:
+        main.clone_content_slide(slide_obj, template, slide_data["title"], slide_data["points"], layout)
+    else:
+        main.draw_content_slide(slide_obj, template, slide_data["title"], slide_data["points"], layout)
+    return slide_obj
+
+def bench_layout(template, layout, repeat):
+    prs = main.new_presentation(template)
+    render_layout_slide(prs, template, layout)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        slide_obj = render_layout_slide(prs, template, layout)
+        timings.append(time.perf_counter() - start)
+    return {
+        "ms": round(min(timings) * 1000, 3),
+        "shapes": len(slide_obj.shapes),
+    }
+
+def run(templates, sizes, deck_repeat, layout_repeat):
+    results = {}
+    layouts = ["title", "introduction", "conclusion"] + main.LAYOUT_TYPES
+    for template in templates:
+        with contextlib.redirect_stdout(io.StringIO()):
+            # Warm the per-worker base presentation and prototype caches before timing anything
+            main.render_ppt_sync(synthetic_deck(12), template["name"])
+            for size in sizes:
+                results[f"deck/{template['name']}/{size}"] = bench_deck(template, size, deck_repeat)
+            for layout in layouts:
+                results[f"layout/{template['name']}/{layout}"] = bench_layout(template, layout, layout_repeat)
+    return results
+
+def summarize(results, sizes):
+    print(f"{'deck size':>10} {'ms':>9} {'ms/slide':>9} {'peak KB':>9} {'shapes':>7} {'bytes':>9}")
+    for size in sizes:
+        rows = [v for k, v in results.items() if k.startswith("deck/") and k.endswith(f"/{size}")]
+        avg = lambda key: sum(r[key] for r in rows) / len(rows)
+        print(f"{size:>10} {avg('ms'):>9.1f} {avg('ms_per_slide'):>9.2f} {avg('peak_kb'):>9.0f} {avg('shapes'):>7.0f} {avg('bytes'):>9.0f}")
+
+    print()
+    print(f"{'layout':>14} {'ms':>8} {'shapes':>7}")
+    layouts = ["title", "introduction", "conclusion"] + main.LAYOUT_TYPES
+    for layout in layouts:
+        rows = [v for k, v in results.items() if k.startswith("layout/") and k.endswith(f"/{layout}")]
+        print(f"{layout:>14} {sum(r['ms'] for r in rows) / len(rows):>8.3f} {sum(r['shapes'] for r in rows) / len(rows):>7.0f}")
+
+def compare(results, baseline, time_tolerance, size_tolerance):
+    """Return a list of human-readable regressions against the baseline"""
+    regressions = []
+    for key, metrics in results.items():
+        if key not in baseline:
+            continue
+        for metric, value in metrics.items():
+            expected = baseline[key].get(metric)
+            if not expected:
+                continue
+            tolerance = time_tolerance if metric.startswith("ms") else size_tolerance
+            if value > expected * (1 + tolerance):
+                regressions.append(f"{key} {metric}: {value} vs baseline {expected} (+{(value / expected - 1) * 100:.0f}%)")
+    return regressions
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DECK_SIZES)
+    parser.add_argument("--templates", nargs="+", help="template names (default: every registry template)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per deck; the best one is kept")
+    parser.add_argument("--layout-repeat", type=int, default=20, help="slides rendered per layout; the best one is kept")
+    parser.add_argument("--baseline", default="bench_baseline.json")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--portable", action="store_true", help="with --update-baseline, keep only machine-independent metrics")
+    parser.add_argument("--time-tolerance", type=float, default=0.5, help="allowed slowdown, 0.5 = 50%%")
+    parser.add_argument("--size-tolerance", type=float, default=0.1, help="allowed growth in memory, shapes and bytes")
+    parser.add_argument("--output", help="write the full results as JSON")
+    args = parser.parse_args()
+
+    templates = [main.get_advanced_design_template(name=name) for name in args.templates] if args.templates else list(main.DESIGN_TEMPLATES)
+    results = run(templates, args.sizes, args.repeat, args.layout_repeat)
+    summarize(results, args.sizes)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+    if args.update_baseline:
+        baseline = results
+        if args.portable:
+            baseline = {key: {metric: metrics[metric] for metric in PORTABLE_METRICS if metric in metrics} for key, metrics in results.items()}
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+        print(f"\nBaseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline at {args.baseline}; run with --update-baseline to record one")
+        return 1
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.time_tolerance, args.size_tolerance)
+    if regressions:
+        print(f"\nRENDER REGRESSIONS ({len(regressions)}):")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print("\nNo regressions against baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
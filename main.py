@@ -2,27 +2,283 @@ import os
 import json
 import asyncio
 import random
-from openai import OpenAI
+import copy
+import hashlib
+import threading
+import multiprocessing
+import sqlite3
+import time
+import re
+import zipfile
+import socket
+import sys
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import MappingProxyType
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from openai import AsyncOpenAI
 from pptx import Presentation
-from pptx.util import Pt, Inches
+from pptx.util import Pt, Inches, Emu
+from PIL import Image, ImageOps
 from pptx.dml.color import RGBColor
 from pptx.enum.text import PP_ALIGN, MSO_ANCHOR
 from pptx.enum.shapes import MSO_SHAPE
 from pptx.oxml.xmlchemy import OxmlElement
+from pptx.oxml.ns import qn
+from pptx.opc.constants import RELATIONSHIP_TYPE as RT
+from lxml import etree
 from telegram import Update
+from telegram.error import BadRequest, Forbidden
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from io import BytesIO
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 FAL_KEY = os.getenv("FAL_KEY")
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", os.cpu_count() or 1))
+IMAGE_CONCURRENCY = int(os.getenv("IMAGE_CONCURRENCY", "8"))
+IMAGES_PER_SLIDE = int(os.getenv("IMAGES_PER_SLIDE", "1"))
+IMAGE_TIMEOUT = float(os.getenv("IMAGE_TIMEOUT", "45"))
+IMAGE_CONNECT_TIMEOUT = float(os.getenv("IMAGE_CONNECT_TIMEOUT", "5"))
+DECK_IMAGE_TIMEOUT = float(os.getenv("DECK_IMAGE_TIMEOUT", "90"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", str(IMAGE_CONCURRENCY)))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.5"))
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "16"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+STREAM_SLIDES = os.getenv("STREAM_SLIDES", "1") == "1"
+PROTOTYPE_SLIDES = os.getenv("PROTOTYPE_SLIDES", "1") == "1"
+PLANNER_MIN_SLIDES = int(os.getenv("PLANNER_MIN_SLIDES", "16"))
+PLANNER_BATCH_SIZE = int(os.getenv("PLANNER_BATCH_SIZE", "6"))
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "1") == "1"
+MIN_SLIDES = 4
+MAX_SLIDES = int(os.getenv("MAX_SLIDES", "60"))
+PROMPT_TOKENS = int(os.getenv("PROMPT_TOKENS", "1200"))
+SLIDE_TOKENS = int(os.getenv("SLIDE_TOKENS", "220"))
+LLM_MAX_COMPLETION_TOKENS = int(os.getenv("LLM_MAX_COMPLETION_TOKENS", "8000"))
+MAX_DECK_TOKENS = int(os.getenv("MAX_DECK_TOKENS", "30000"))
+RENDER_SECONDS_PER_SLIDE = float(os.getenv("RENDER_SECONDS_PER_SLIDE", "0.05"))
+MAX_RENDER_SECONDS = float(os.getenv("MAX_RENDER_SECONDS", "30"))
+TEMPLATE_FILE = os.getenv("TEMPLATE_FILE")
+CONTENT_CACHE_ENABLED = os.getenv("CONTENT_CACHE", "1") == "1"
+CONTENT_CACHE_PATH = os.getenv("CONTENT_CACHE_PATH", "content_cache.sqlite3")
+CONTENT_CACHE_TTL = float(os.getenv("CONTENT_CACHE_TTL", str(7 * 24 * 3600)))
+CONTENT_CACHE_MAX_ENTRIES = int(os.getenv("CONTENT_CACHE_MAX_ENTRIES", "5000"))
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "image_cache")
+IMAGE_CACHE_MEMORY_MB = float(os.getenv("IMAGE_CACHE_MEMORY_MB", "64"))
+IMAGE_CACHE_DISK_MB = float(os.getenv("IMAGE_CACHE_DISK_MB", "1024"))
+IMAGE_DPI = int(os.getenv("IMAGE_DPI", "96"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "jpeg").lower()
+FILE_ID_CACHE_ENABLED = os.getenv("FILE_ID_CACHE", "1") == "1"
+FILE_ID_CACHE_MAX_ENTRIES = int(os.getenv("FILE_ID_CACHE_MAX_ENTRIES", "20000"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_DEPTH = int(os.getenv("JOB_QUEUE_DEPTH", "50"))
+# Streamed decks hold a render process for the whole LLM stream, so they get their own pool
+STREAM_RENDER_WORKERS = int(os.getenv("STREAM_RENDER_WORKERS", str(JOB_WORKERS)))
+CONVERSATION_TTL = float(os.getenv("CONVERSATION_TTL", str(6 * 3600)))
+CONVERSATION_SWEEP_INTERVAL = float(os.getenv("CONVERSATION_SWEEP_INTERVAL", "600"))
+CONVERSATION_DB = os.getenv("CONVERSATION_DB", "")
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+DECK_BROKER = os.getenv("DECK_BROKER", "")
+BROKER_POLL_INTERVAL = float(os.getenv("BROKER_POLL_INTERVAL", "1"))
+BROKER_JOB_TIMEOUT = float(os.getenv("BROKER_JOB_TIMEOUT", "900"))
+BROKER_DELIVERY_ATTEMPTS = int(os.getenv("BROKER_DELIVERY_ATTEMPTS", "5"))
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+async_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=HTTP_RETRIES, timeout=LLM_TIMEOUT)
+llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
 
 TOPIC, NUM_SLIDES, UNIVERSITY, STUDENT_NAME, FROM_TO = range(5)
 
-user_data_store = {}
+XML_INVALID_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0d\x0e-\x1f]")
+LAYOUT_TYPES = ["cards", "two_column", "timeline", "comparison", "grid", "numbered", "highlight", "icon_based"]
+
+render_pool = None
+stream_render_pool = None
+render_manager = None
+template_base_cache = {}
+slide_prototype_cache = {}
+image_pool = ThreadPoolExecutor(max_workers=IMAGE_CONCURRENCY, thread_name_prefix="image")
+
+def create_http_session():
+    """Shared keep-alive session with per-host connection pools and retry/backoff
+
+    Only idempotent requests are retried after a read error or 5xx; the fal.run POST is paid, so
+    it is retried on connection errors alone and never generates (and bills) an image twice.
+    """
+    retry = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF,
+        status_forcelist=(429, 500, 502, 503, 504),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, pool_block=True, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+http_session = create_http_session()
+
+content_cache_db = None
+content_cache_lock = threading.Lock()
+content_cache_stats = {"hits": 0, "misses": 0, "expired": 0}
+
+image_cache = OrderedDict()
+image_cache_bytes = 0
+image_cache_lock = threading.Lock()
+image_cache_stats = {"hits": 0, "misses": 0, "disk_hits": 0, "evictions": 0}
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class StageMetrics:
+    """Latency histograms, error counters and in-flight gauges per pipeline stage"""
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.errors = {}
+        self.in_flight = {}
+        self.events = None
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            counts, total = self.histograms.get(stage, ([0] * (len(self.buckets) + 1), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self.histograms[stage] = (counts, total + seconds)
+            if self.events is not None:
+                self.events.append(("observe", stage, seconds))
+
+    def error(self, stage):
+        with self.lock:
+            self.errors[stage] = self.errors.get(stage, 0) + 1
+            if self.events is not None:
+                self.events.append(("error", stage, None))
+
+    @contextmanager
+    def track(self, stage):
+        """Time the block under stage, counting it in flight and as an error if it raises"""
+        with self.lock:
+            self.in_flight[stage] = self.in_flight.get(stage, 0) + 1
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.error(stage)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+            with self.lock:
+                self.in_flight[stage] -= 1
+
+    @contextmanager
+    def capture(self):
+        """Collect the events recorded inside the block so a render worker can ship them back"""
+        self.events = []
+        try:
+            yield self.events
+        finally:
+            self.events = None
+
+    def replay(self, events):
+        for kind, stage, seconds in events:
+            if kind == "observe":
+                self.observe(stage, seconds)
+            else:
+                self.error(stage)
+
+    def render(self):
+        """Prometheus text exposition of every stage plus the cache counters"""
+        with self.lock:
+            histograms = {stage: (list(counts), total) for stage, (counts, total) in self.histograms.items()}
+            errors = dict(self.errors)
+            in_flight = dict(self.in_flight)
+        lines = [
+            "# HELP slayd_stage_duration_seconds Time spent in each pipeline stage",
+            "# TYPE slayd_stage_duration_seconds histogram",
+        ]
+        for stage, (counts, total) in sorted(histograms.items()):
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'slayd_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+            lines.append(f'slayd_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {counts[-1]}')
+            lines.append(f'slayd_stage_duration_seconds_sum{{stage="{stage}"}} {total}')
+            lines.append(f'slayd_stage_duration_seconds_count{{stage="{stage}"}} {counts[-1]}')
+        lines += [
+            "# HELP slayd_stage_errors_total Failures per pipeline stage",
+            "# TYPE slayd_stage_errors_total counter",
+        ]
+        lines += [f'slayd_stage_errors_total{{stage="{stage}"}} {count}' for stage, count in sorted(errors.items())]
+        lines += [
+            "# HELP slayd_stage_in_flight Stage executions currently running",
+            "# TYPE slayd_stage_in_flight gauge",
+        ]
+        lines += [f'slayd_stage_in_flight{{stage="{stage}"}} {count}' for stage, count in sorted(in_flight.items())]
+        lines += [
+            "# HELP slayd_cache_events_total Content and image cache lookups and evictions",
+            "# TYPE slayd_cache_events_total counter",
+        ]
+        for cache, stats in (("content", content_cache_stats), ("image", image_cache_stats)):
+            lines += [f'slayd_cache_events_total{{cache="{cache}",event="{event}"}} {count}' for event, count in stats.items()]
+        return "\n".join(lines) + "\n"
+
+stage_metrics = StageMetrics()
+metrics_server = None
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = stage_metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server():
+    """Serve stage_metrics at http://METRICS_HOST:METRICS_PORT/metrics; METRICS_PORT=0 turns it off"""
+    global metrics_server
+    if METRICS_PORT <= 0 or metrics_server is not None:
+        return
+    try:
+        metrics_server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+    except OSError as e:
+        print(f"[v0] Metrics endpoint unavailable: {e}")
+        return
+    metrics_server.daemon_threads = True
+    threading.Thread(target=metrics_server.serve_forever, name="metrics", daemon=True).start()
+    print(f"[v0] Metrics at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+def run_with_metrics(fn, *args):
+    """Render pool entry point: run fn and return its result with the stage events it recorded"""
+    with stage_metrics.capture() as events:
+        result = fn(*args)
+    return result, events
 
 def add_advanced_shadow(shape, blur=8, distance=4, angle=45, transparency=0.2):
     """Add advanced shadow with customizable parameters for depth"""
@@ -48,8 +304,125 @@ def add_glow_effect(shape, size=10, transparency=0.5, color=None):
     except:
         pass
 
+def image_cache_key(prompt, image_size, steps):
+    # Cached bytes are normalized, so the normalization settings are part of the key
+    variant = f"{IMAGE_FORMAT}:{IMAGE_DPI}:{IMAGE_QUALITY}"
+    return hashlib.sha256(f"{prompt}\x00{image_size}\x00{steps}\x00{variant}".encode("utf-8")).hexdigest()
+
+def image_cache_remember(key, data):
+    """Keep image bytes in the in-memory LRU, evicting the oldest entries past IMAGE_CACHE_MEMORY_MB"""
+    global image_cache_bytes
+    limit = IMAGE_CACHE_MEMORY_MB * 1024 * 1024
+    if len(data) > limit:
+        return
+    with image_cache_lock:
+        if key in image_cache:
+            image_cache.move_to_end(key)
+            return
+        image_cache[key] = data
+        image_cache_bytes += len(data)
+        while image_cache_bytes > limit:
+            _, evicted = image_cache.popitem(last=False)
+            image_cache_bytes -= len(evicted)
+            image_cache_stats["evictions"] += 1
+
+def image_cache_get(key):
+    """Look an image up in memory, then on disk"""
+    with image_cache_lock:
+        data = image_cache.get(key)
+        if data is not None:
+            image_cache.move_to_end(key)
+            image_cache_stats["hits"] += 1
+            return data
+    
+    if IMAGE_CACHE_DIR:
+        path = os.path.join(IMAGE_CACHE_DIR, key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            data = None
+        if data is not None:
+            with image_cache_lock:
+                image_cache_stats["hits"] += 1
+                image_cache_stats["disk_hits"] += 1
+            image_cache_remember(key, data)
+            return data
+    
+    with image_cache_lock:
+        image_cache_stats["misses"] += 1
+    return None
+
+def image_cache_put(key, data):
+    """Store image bytes in memory and on disk, trimming the disk cache to IMAGE_CACHE_DISK_MB"""
+    image_cache_remember(key, data)
+    if not IMAGE_CACHE_DIR:
+        return
+    
+    try:
+        os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+        path = os.path.join(IMAGE_CACHE_DIR, key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        
+        entries = [e for e in os.scandir(IMAGE_CACHE_DIR) if e.is_file() and not e.name.endswith(".tmp")]
+        total = sum(e.stat().st_size for e in entries)
+        limit = IMAGE_CACHE_DISK_MB * 1024 * 1024
+        if total > limit:
+            for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+                if total <= limit:
+                    break
+                total -= entry.stat().st_size
+                os.remove(entry.path)
+                with image_cache_lock:
+                    image_cache_stats["evictions"] += 1
+    except OSError as e:
+        print(f"[v0] Image cache write error: {e}")
+
+SLIDE_IMAGE_BOX = (10, 7.5)
+
+def normalize_image(image_bytes, box=SLIDE_IMAGE_BOX):
+    """Crop to the placement box's aspect, shrink to IMAGE_DPI and re-encode as IMAGE_FORMAT
+
+    Images already smaller than the box are cropped but never scaled up. Returns the original
+    bytes if the image can't be decoded.
+    """
+    target_width, target_height = round(box[0] * IMAGE_DPI), round(box[1] * IMAGE_DPI)
+    try:
+        with stage_metrics.track("image_normalize"):
+            image = Image.open(BytesIO(image_bytes))
+            # JPEG can decode straight at a reduced scale, which is much cheaper than a full decode
+            image.draft("RGB", (target_width, target_height))
+            scale = max(target_width / image.width, target_height / image.height)
+            if scale > 1:
+                target_width, target_height = max(1, round(target_width / scale)), max(1, round(target_height / scale))
+            image = ImageOps.fit(image.convert("RGB"), (target_width, target_height), Image.LANCZOS)
+            output = BytesIO()
+            if IMAGE_FORMAT == "png":
+                image.save(output, "PNG", optimize=True)
+            else:
+                image.save(output, "JPEG", quality=IMAGE_QUALITY, dpi=(IMAGE_DPI, IMAGE_DPI))
+        return output.getvalue()
+    except Exception as e:
+        print(f"[v0] Image normalization failed, keeping original: {e}")
+        return image_bytes
+
 def generate_image_sync(prompt: str):
     """Generate image using fal.ai API with enhanced prompts"""
+    # Enhanced prompt for better quality
+    enhanced_prompt = f"{prompt}, ultra professional, 8k quality, highly detailed, modern minimalist design, clean aesthetic, corporate style, premium look, sophisticated composition"
+    image_size = "landscape_16_9"
+    steps = 4
+    
+    cache_key = image_cache_key(enhanced_prompt, image_size, steps)
+    cached = image_cache_get(cache_key)
+    if cached is not None:
+        print(f"[v0] Image cache hit: {prompt[:50]}...")
+        return BytesIO(cached)
+    
     if not FAL_KEY:
         print("[v0] FAL_KEY not found, skipping image generation")
         return None
@@ -60,32 +433,43 @@ def generate_image_sync(prompt: str):
             "Content-Type": "application/json"
         }
         
-        # Enhanced prompt for better quality
         payload = {
-            "prompt": f"{prompt}, ultra professional, 8k quality, highly detailed, modern minimalist design, clean aesthetic, corporate style, premium look, sophisticated composition",
-            "image_size": "landscape_16_9",
-            "num_inference_steps": 4,
+            "prompt": enhanced_prompt,
+            "image_size": image_size,
+            "num_inference_steps": steps,
             "num_images": 1
         }
         
         print(f"[v0] Generating enhanced image: {prompt[:50]}...")
         
-        response = requests.post(
-            "https://fal.run/fal-ai/flux/schnell",
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
+        # Retries included, the fetch fits in IMAGE_TIMEOUT, so the image_pool thread and its pooled
+        # connection are free again by the time generate_image stops waiting
+        deadline = time.monotonic() + IMAGE_TIMEOUT
+        downloaded = None
+        with stage_metrics.track("image_fetch"):
+            response = http_session.post(
+                "https://fal.run/fal-ai/flux/schnell",
+                headers=headers,
+                json=payload,
+                timeout=(IMAGE_CONNECT_TIMEOUT, IMAGE_TIMEOUT / 2)
+            )
+            
+            remaining = deadline - time.monotonic()
+            if response.status_code == 200 and remaining > 1:
+                result = response.json()
+                if result and 'images' in result and len(result['images']) > 0:
+                    image_url = result['images'][0]['url']
+                    img_response = http_session.get(image_url, timeout=remaining / (HTTP_RETRIES + 1))
+                    if img_response.status_code == 200:
+                        downloaded = img_response.content
         
-        if response.status_code == 200:
-            result = response.json()
-            if result and 'images' in result and len(result['images']) > 0:
-                image_url = result['images'][0]['url']
-                img_response = requests.get(image_url, timeout=15)
-                if img_response.status_code == 200:
-                    print(f"[v0] Enhanced image generated successfully")
-                    return BytesIO(img_response.content)
+        if downloaded is not None:
+            print(f"[v0] Enhanced image generated successfully")
+            image_bytes = normalize_image(downloaded)
+            image_cache_put(cache_key, image_bytes)
+            return BytesIO(image_bytes)
         
+        stage_metrics.error("image_fetch")
         print(f"[v0] Image generation failed: {response.status_code}")
     except Exception as e:
         print(f"[v0] Image generation error: {e}")
@@ -93,10 +477,52 @@ def generate_image_sync(prompt: str):
     return None
 
 async def generate_image(prompt: str):
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, generate_image_sync, prompt)
+    loop = asyncio.get_running_loop()
+    try:
+        return await asyncio.wait_for(loop.run_in_executor(image_pool, generate_image_sync, prompt), IMAGE_TIMEOUT)
+    except asyncio.TimeoutError:
+        stage_metrics.error("image_fetch")
+        print(f"[v0] Image timed out after {IMAGE_TIMEOUT}s: {prompt[:50]}...")
+        return None
+
+async def fetch_slide_image(slide_data):
+    """Run a slide's image prompts concurrently and return the first image that arrives"""
+    tasks = [asyncio.ensure_future(generate_image(prompt)) for prompt in slide_data.get("image_prompts", [])[:IMAGES_PER_SLIDE]]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            image = await next_done
+            if image is not None:
+                return image.getvalue()
+    finally:
+        for task in tasks:
+            task.cancel()
+    return None
+
+async def fetch_deck_images(content):
+    """Start image generation for every slide at once and keep what arrives before DECK_IMAGE_TIMEOUT"""
+    if not FAL_KEY or IMAGES_PER_SLIDE <= 0:
+        return {}
+    
+    tasks = {
+        asyncio.ensure_future(fetch_slide_image(slide_data)): idx
+        for idx, slide_data in enumerate(content)
+        if slide_data.get("image_prompts")
+    }
+    if not tasks:
+        return {}
+    
+    print(f"[v0] Generating images for {len(tasks)} slides...")
+    done, pending = await asyncio.wait(tasks, timeout=DECK_IMAGE_TIMEOUT)
+    images = {tasks[task]: task.result() for task in done if task.result() is not None}
+    
+    for task in pending:
+        task.cancel()
+    if pending:
+        print(f"[v0] Deck image deadline reached, {len(pending)} slides left without images")
+    print(f"[v0] Images ready for {len(images)}/{len(content)} slides (cache: {image_cache_stats})")
+    return images
 
-def generate_slide_content_sync(topic: str, slides: int, university: str, student_name: str, from_to: str):
+def build_slide_prompt(topic: str, slides: int, university: str, student_name: str, from_to: str):
     num_content_slides = slides - 3
     
     prompt = f"""
@@ -139,7 +565,8 @@ JSON array qaytaring (faqat JSON, boshqa hech narsa yo'q):
     "outline": [
       "Birinchi bo'lim - qisqa",
       "Ikkinchi bo'lim - qisqa",
-      "Uchinchi bo'lim - qisqa"
+      "Uchinchi bo'lim - qisqa",
+      "To'rtinchi bo'lim - qisqa"
     ],
     "image_prompts": [
       "{topic} introduction concept",
@@ -181,19 +608,196 @@ ESLATMA: Aynan {num_content_slides} ta "content" tipidagi slayd yarating. Barcha
 
 Faqat to'g'ri JSON qaytaring, qo'shimcha matn yoki kod bloklarsiz.
 """
+    return prompt
+
+# Slide schema: the text and list fields each slide type must carry. It drives both the JSON schema
+# sent as the structured-output response_format and validate_slide, which checks slides before
+# they are rendered. Lists need at least SLIDE_LIST_MIN items (1 when unlisted), the same minimums
+# the introduction and conclusion layouts need to draw their item boxes.
+SLIDE_FIELDS = {
+    "title": {"title": "text", "university": "text", "student": "text", "from_to": "text"},
+    "introduction": {"title": "text", "content": "text", "outline": "list"},
+    "content": {"title": "text", "points": "list"},
+    "conclusion": {"title": "text", "summary": "text", "takeaways": "list"},
+}
+SLIDE_LIST_MIN = {"outline": 4, "points": 4, "takeaways": 3}
+
+def slide_json_schema(slide_type):
+    properties = {"type": {"type": "string", "enum": [slide_type]}}
+    for field, kind in SLIDE_FIELDS[slide_type].items():
+        properties[field] = {"type": "string"} if kind == "text" else {"type": "array", "items": {"type": "string"}}
+    properties["image_prompts"] = {"type": "array", "items": {"type": "string"}}
+    # Strict mode wants every property required and nothing else allowed
+    return {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+
+def json_schema_format(name, schema):
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+# The root of a structured output must be an object, so slide arrays come wrapped as {"slides": [...]}
+SLIDES_RESPONSE_FORMAT = json_schema_format("slides", {
+    "type": "object",
+    "properties": {"slides": {"type": "array", "items": {"anyOf": [slide_json_schema(slide_type) for slide_type in SLIDE_FIELDS]}}},
+    "required": ["slides"],
+    "additionalProperties": False,
+})
+OUTLINE_RESPONSE_FORMAT = json_schema_format("outline", {
+    "type": "object",
+    "properties": {
+        "title": slide_json_schema("title"),
+        "introduction": slide_json_schema("introduction"),
+        "sections": {"type": "array", "items": {"type": "string"}},
+        "conclusion": slide_json_schema("conclusion"),
+    },
+    "required": ["title", "introduction", "sections", "conclusion"],
+    "additionalProperties": False,
+})
+SLIDE_RESPONSE_FORMATS = {slide_type: json_schema_format(f"{slide_type}_slide", slide_json_schema(slide_type)) for slide_type in SLIDE_FIELDS}
+
+def structured(response_format):
+    """response_format to request, or None when STRUCTURED_OUTPUT is off"""
+    return response_format if STRUCTURED_OUTPUT else None
 
+def slide_type_of(slide_data):
+    slide_type = slide_data.get("type", "content")
+    return slide_type if slide_type in SLIDE_FIELDS else "content"
+
+def validate_slide(slide_data):
+    """Problems that keep a slide from matching SLIDE_FIELDS; empty when it can be rendered as is"""
+    if not isinstance(slide_data, dict):
+        return ["not an object"]
+    slide_type = slide_data.get("type", "content")
+    if slide_type not in SLIDE_FIELDS:
+        return [f"unknown type {slide_type!r}"]
+    errors = []
+    for field, kind in SLIDE_FIELDS[slide_type].items():
+        value = slide_data.get(field)
+        if kind == "text":
+            if not isinstance(value, str) or not value.strip():
+                errors.append(f"{field} missing")
+        else:
+            minimum = SLIDE_LIST_MIN.get(field, 1)
+            if not isinstance(value, list) or sum(1 for item in value if isinstance(item, str) and item.strip()) < minimum:
+                errors.append(f"{field} needs {minimum} items")
+    prompts = slide_data.get("image_prompts", [])
+    if not isinstance(prompts, list) or not all(isinstance(prompt, str) for prompt in prompts):
+        errors.append("image_prompts must be a list of strings")
+    return errors
+
+def build_slide_fix_prompt(topic: str, slide_data, errors):
+    slide_type = slide_type_of(slide_data) if isinstance(slide_data, dict) else "content"
+    current = json.dumps(slide_data, ensure_ascii=False)[:1500]
+    
+    prompt = f"""
+Mavzu: "{topic}" haqidagi taqdimotning bitta "{slide_type}" slaydi talabga javob bermaydi ({'; '.join(errors)}).
+Shu slaydni to'liq qayta yozing. Barcha matn O'ZBEK TILIDA bo'lishi kerak.
+
+Hozirgi slayd:
+{current}
+
+Talablar: har bir matn maydoni to'ldirilgan bo'lsin; "points" va "outline" 4 ta, "takeaways" 3 ta qisqa banddan iborat bo'lsin.
+Faqat bitta JSON obyekt qaytaring (faqat JSON, boshqa hech narsa yo'q).
+"""
+    return prompt
+
+def fixed_slide(slide_data, response):
+    """The regenerated slide from a fix response, or the original when the fix is no better"""
+    replacement = parse_slide_response(response) if response is not None else None
+    if isinstance(replacement, list) and replacement:
+        replacement = replacement[0]
+    if isinstance(replacement, dict):
+        replacement = {**replacement, "type": slide_type_of(slide_data)}
+        if not validate_slide(replacement):
+            return replacement
+    print(f"[v0] Slide fix failed, keeping original: {slide_data.get('title', '')}")
+    return slide_data
+
+def fill_title_slide(slide_data, topic, university, student_name, from_to):
+    """Title slides are fixed locally: every field but the title comes from the user anyway"""
+    return {**slide_data, "title": slide_data.get("title") or topic, "university": university, "student": student_name, "from_to": from_to}
+
+def strip_code_fence(content):
+    content = content.strip()
+    if content.startswith("```"):
+        content = content.split("\n", 1)[1] if "\n" in content else ""
+    if content.rstrip().endswith("```"):
+        content = content.rstrip()[:-3]
+    return content.strip()
+
+def strip_trailing_commas(text):
+    """Drop commas that directly precede a closing bracket, leaving string contents alone"""
+    out = []
+    in_string = escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "]}":
+            end = len(out)
+            while end and out[end - 1].isspace():
+                end -= 1
+            if end and out[end - 1] == ",":
+                del out[end - 1:]
+        out.append(char)
+    return "".join(out)
+
+def close_truncated_json(text):
+    """Cut text back to its last complete value (string or bracket) and close what is still open, or None"""
+    stack = []
+    cut_points = []
+    in_string = escaped = False
+    for pos, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+                cut_points.append((pos + 1, "".join(reversed(stack))))
+        elif char == '"':
+            in_string = True
+        elif char in "[{":
+            stack.append("]" if char == "[" else "}")
+        elif char in "]}":
+            if not stack:
+                break
+            stack.pop()
+            cut_points.append((pos + 1, "".join(reversed(stack))))
+    for end, closers in reversed(cut_points):
+        try:
+            return json.loads(strip_trailing_commas(text[:end].rstrip().rstrip(",") + closers))
+        except ValueError:
+            continue
+    return None
+
+def repair_slide_json(content):
+    """Best-effort parse of malformed model output
+
+    Skips prose around the JSON, drops trailing commas and, for a truncated or partly broken
+    array, keeps every slide object that is complete. Returns None when nothing is salvageable.
+    """
+    starts = [pos for pos in (content.find("["), content.find("{")) if pos != -1]
+    if not starts:
+        return None
+    content = strip_trailing_commas(content[min(starts):])
+    closer = "]" if content[0] == "[" else "}"
     try:
-        print("[v0] Calling OpenAI API for content generation...")
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.8
-        )
-        print("[v0] OpenAI API call successful")
-    except Exception as e:
-        print(f"[v0] OpenAI API error: {e}")
-        return []
+        return json.loads(content[:content.rfind(closer) + 1])
+    except ValueError:
+        pass
+    if content[0] == "[":
+        slides = SlideStreamParser().feed(content)
+        return slides or None
+    return close_truncated_json(content)
 
+def parse_slide_response(response):
+    """Pull the slide JSON out of a chat completion, repairing it if needed, or [] if it is unusable"""
     try:
         content = response.choices[0].message.content
         print(f"[v0] Received content from OpenAI (length: {len(content)})")
@@ -201,208 +805,725 @@ Faqat to'g'ri JSON qaytaring, qo'shimcha matn yoki kod bloklarsiz.
         print(f"[v0] No content from OpenAI: {e}")
         return []
 
-    if content.startswith("\`\`\`json"):
-        content = content[len("\`\`\`json"):].strip()
-    elif content.startswith("\`\`\`"):
-        content = content[len("\`\`\`"):].strip()
-    if content.endswith("\`\`\`"):
-        content = content[:-3].strip()
+    content = strip_code_fence(content)
 
     try:
-        slides_data = json.loads(content)
+        with stage_metrics.track("json_parse"):
+            slides_data = unwrap_slides(json.loads(content))
         print(f"[v0] Successfully parsed {len(slides_data)} slides")
     except Exception as e:
         print(f"[v0] JSON parsing error: {e}")
-        print(f"[v0] Raw response: {content[:500]}...")
-        return []
+        with stage_metrics.track("json_repair"):
+            slides_data = unwrap_slides(repair_slide_json(content))
+        if not slides_data:
+            print(f"[v0] Raw response: {content[:500]}...")
+            return []
+        print(f"[v0] Repaired malformed JSON, kept {len(slides_data)} items")
 
     return slides_data
 
-async def generate_slide_content(topic: str, slides: int, university: str, student_name: str, from_to: str):
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, generate_slide_content_sync, topic, slides, university, student_name, from_to)
+def unwrap_slides(data):
+    """Structured output wraps slide arrays as {"slides": [...]}"""
+    if isinstance(data, dict) and isinstance(data.get("slides"), list):
+        return data["slides"]
+    return data
+
+def slide_dicts(content):
+    """The slide objects of a parsed array; repaired output can carry stray strings or numbers"""
+    return [slide_data for slide_data in content if isinstance(slide_data, dict)]
 
-def get_advanced_design_template(seed):
-    """Get one of 18 ultra-modern professionally designed templates with PERFECT READABILITY"""
-    random.seed(seed)
+def missing_slides(content, slides):
+    """(needs introduction, number of missing content slides, needs conclusion) for a partial deck"""
+    types = [slide_data.get("type", "content") for slide_data in slide_dicts(content)]
+    return "introduction" not in types, max(0, slides - 3 - types.count("content")), "conclusion" not in types
+
+def build_missing_slides_prompt(topic: str, content, slides: int):
+    need_introduction, content_count, need_conclusion = missing_slides(content, slides)
+    present = "\n".join(f"- {slide_data.get('title', '')}" for slide_data in slide_dicts(content) if slide_data.get("title"))
+    wanted = []
+    if need_introduction:
+        wanted.append('- 1 ta "introduction" slayd: {"type": "introduction", "title": "Kirish va Reja", "content": "30-40 so\'z", "outline": ["...", "...", "...", "..."], "image_prompts": ["..."]}')
+    if content_count:
+        wanted.append(f'- {content_count} ta "content" slayd: {{"type": "content", "title": "Qisqa sarlavha", "points": ["4 ta nuqta, har biri 10-12 so\'z"], "image_prompts": ["..."]}}')
+    if need_conclusion:
+        wanted.append('- 1 ta "conclusion" slayd: {"type": "conclusion", "title": "Xulosa", "summary": "40-50 so\'z", "takeaways": ["...", "...", "..."], "image_prompts": ["..."]}')
+    wanted = "\n".join(wanted)
     
-    templates = [
-        # Minimalist Modern Series
-        {
-            "name": "Arctic Minimalist",
-            "bg_color": RGBColor(255, 255, 255),
-            "primary": RGBColor(10, 10, 10),
-            "accent": RGBColor(0, 122, 255),
-            "text_primary": RGBColor(10, 10, 10),
-            "text_secondary": RGBColor(100, 100, 100),
-            "shape_fill": RGBColor(248, 249, 250),
-            "shape_text": RGBColor(10, 10, 10),  # Dark text on light shape
-            "shape_border": RGBColor(0, 122, 255),
-            "gradient_start": RGBColor(240, 248, 255),
-            "gradient_end": RGBColor(255, 255, 255),
-            "title_font_size": 52,
-            "subtitle_font_size": 26,
-            "content_font_size": 18,
-            "style": "minimalist"
-        },
-        {
-            "name": "Dark Mode Elite",
-            "bg_color": RGBColor(18, 18, 18),
-            "primary": RGBColor(0, 229, 255),
-            "accent": RGBColor(138, 43, 226),
-            "text_primary": RGBColor(255, 255, 255),
-            "text_secondary": RGBColor(200, 200, 200),
-            "shape_fill": RGBColor(30, 30, 30),
-            "shape_text": RGBColor(255, 255, 255),  # Light text on dark shape
-            "shape_border": RGBColor(0, 229, 255),
-            "gradient_start": RGBColor(25, 25, 35),
-            "gradient_end": RGBColor(18, 18, 18),
-            "title_font_size": 50,
-            "subtitle_font_size": 25,
-            "content_font_size": 17,
-            "style": "dark_modern"
-        },
-        {
-            "name": "Professional Blue",
-            "bg_color": RGBColor(245, 248, 252),
-            "primary": RGBColor(25, 118, 210),
-            "accent": RGBColor(66, 165, 245),
-            "text_primary": RGBColor(13, 71, 161),
-            "text_secondary": RGBColor(25, 118, 210),
-            "shape_fill": RGBColor(255, 255, 255),
-            "shape_text": RGBColor(13, 71, 161),  # Dark blue text on white
-            "shape_border": RGBColor(66, 165, 245),
-            "gradient_start": RGBColor(227, 242, 253),
-            "gradient_end": RGBColor(245, 248, 255),
-            "title_font_size": 48,
-            "subtitle_font_size": 24,
-            "content_font_size": 17,
-            "style": "corporate"
-        },
-        {
-            "name": "Emerald Business",
-            "bg_color": RGBColor(255, 255, 255),
-            "primary": RGBColor(0, 105, 92),
-            "accent": RGBColor(0, 200, 83),
-            "text_primary": RGBColor(0, 77, 64),
-            "text_secondary": RGBColor(69, 90, 100),
-            "shape_fill": RGBColor(232, 245, 233),
-            "shape_text": RGBColor(0, 77, 64),  # Dark green text on light green
-            "shape_border": RGBColor(0, 105, 92),
-            "gradient_start": RGBColor(232, 245, 233),
-            "gradient_end": RGBColor(255, 255, 255),
-            "title_font_size": 48,
-            "subtitle_font_size": 24,
-            "content_font_size": 17,
-            "style": "corporate"
-        },
-        {
-            "name": "Ocean Depth",
-            "bg_color": RGBColor(240, 248, 255),
-            "primary": RGBColor(0, 105, 148),
-            "accent": RGBColor(0, 188, 212),
-            "text_primary": RGBColor(1, 87, 155),
-            "text_secondary": RGBColor(38, 50, 56),
-            "shape_fill": RGBColor(255, 255, 255),
-            "shape_text": RGBColor(1, 87, 155),  # Dark blue text on white
-            "shape_border": RGBColor(0, 188, 212),
-            "gradient_start": RGBColor(224, 247, 250),
-            "gradient_end": RGBColor(240, 248, 255),
-            "title_font_size": 48,
-            "subtitle_font_size": 24,
-            "content_font_size": 17,
-            "style": "nature_modern"
-        },
-        {
-            "name": "Forest Canopy",
-            "bg_color": RGBColor(249, 251, 248),
-            "primary": RGBColor(27, 94, 32),
-            "accent": RGBColor(76, 175, 80),
-            "text_primary": RGBColor(27, 94, 32),
-            "text_secondary": RGBColor(56, 142, 60),
-            "shape_fill": RGBColor(255, 255, 255),
-            "shape_text": RGBColor(27, 94, 32),  # Dark green text on white
-            "shape_border": RGBColor(76, 175, 80),
-            "gradient_start": RGBColor(232, 245, 233),
-            "gradient_end": RGBColor(249, 251, 248),
-            "title_font_size": 48,
-            "subtitle_font_size": 24,
-            "content_font_size": 17,
-            "style": "nature_modern"
-        },
-        {
-            "name": "Sunset Gradient",
-            "bg_color": RGBColor(255, 250, 245),
-            "primary": RGBColor(211, 47, 47),
-            "accent": RGBColor(255, 152, 0),
-            "text_primary": RGBColor(183, 28, 28),
-            "text_secondary": RGBColor(191, 54, 12),
-            "shape_fill": RGBColor(255, 255, 255),
-            "shape_text": RGBColor(183, 28, 28),  # Dark red text on white
-            "shape_border": RGBColor(255, 152, 0),
-            "gradient_start": RGBColor(255, 245, 238),
-            "gradient_end": RGBColor(255, 250, 245),
-            "title_font_size": 50,
-            "subtitle_font_size": 26,
-            "content_font_size": 18,
-            "style": "gradient_bold"
-        },
-        {
-            "name": "Royal Purple",
-            "bg_color": RGBColor(248, 245, 255),
-            "primary": RGBColor(94, 53, 177),
-            "accent": RGBColor(156, 39, 176),
-            "text_primary": RGBColor(74, 20, 140),
-            "text_secondary": RGBColor(106, 27, 154),
-            "shape_fill": RGBColor(255, 255, 255),
-            "shape_text": RGBColor(74, 20, 140),  # Dark purple text on white
-            "shape_border": RGBColor(156, 39, 176),
-            "gradient_start": RGBColor(237, 231, 246),
-            "gradient_end": RGBColor(248, 245, 255),
-            "title_font_size": 50,
-            "subtitle_font_size": 25,
-            "content_font_size": 17,
-            "style": "creative"
-        },
-        {
-            "name": "Monochrome Pro",
-            "bg_color": RGBColor(255, 255, 255),
-            "primary": RGBColor(33, 33, 33),
-            "accent": RGBColor(117, 117, 117),
-            "text_primary": RGBColor(33, 33, 33),
-            "text_secondary": RGBColor(97, 97, 97),
-            "shape_fill": RGBColor(245, 245, 245),
-            "shape_text": RGBColor(33, 33, 33),  # Dark text on light gray
-            "shape_border": RGBColor(33, 33, 33),
-            "gradient_start": RGBColor(245, 245, 245),
-            "gradient_end": RGBColor(255, 255, 255),
-            "title_font_size": 50,
-            "subtitle_font_size": 25,
-            "content_font_size": 17,
-            "style": "monochrome"
-        },
-        {
-            "name": "Charcoal Elegance",
-            "bg_color": RGBColor(250, 250, 250),
-            "primary": RGBColor(55, 71, 79),
-            "accent": RGBColor(96, 125, 139),
-            "text_primary": RGBColor(38, 50, 56),
-            "text_secondary": RGBColor(69, 90, 100),
-            "shape_fill": RGBColor(255, 255, 255),
-            "shape_text": RGBColor(38, 50, 56),  # Dark text on white
-            "shape_border": RGBColor(96, 125, 139),
-            "gradient_start": RGBColor(236, 239, 241),
-            "gradient_end": RGBColor(250, 250, 250),
-            "title_font_size": 48,
-            "subtitle_font_size": 24,
-            "content_font_size": 17,
-            "style": "monochrome"
-        }
-    ]
+    prompt = f"""
+Mavzu: "{topic}" haqidagi taqdimotning ba'zi slaydlari yetishmayapti. Barcha matn O'ZBEK TILIDA bo'lishi kerak.
+
+Mavjud slaydlar (ularni takrorlamang):
+{present}
+
+Faqat quyidagi slaydlarni, aynan shu tartibda yarating:
+{wanted}
+
+JSON array qaytaring (faqat JSON, boshqa hech narsa yo'q).
+"""
+    return prompt
+
+def assemble_slides(content, slides, topic, university, student_name, from_to):
+    """Order salvaged and re-requested slides as title, introduction, content..., conclusion"""
+    by_type = {}
+    for slide_data in slide_dicts(content):
+        by_type.setdefault(slide_data.get("type", "content"), []).append(slide_data)
+    title = by_type.get("title", [{"type": "title", "title": topic, "university": university, "student": student_name, "from_to": from_to}])[0]
+    deck = [title] + by_type.get("introduction", [])[:1] + by_type.get("content", [])[:slides - 3] + by_type.get("conclusion", [])[:1]
+    return deck
+
+def needs_completion(content, slides):
+    return isinstance(content, list) and content and any(missing_slides(content, slides))
+
+async def request_completion(prompt, response_format=None):
+    extra = {"response_format": response_format} if response_format is not None else {}
+    try:
+        async with llm_semaphore:
+            print("[v0] Calling OpenAI API for content generation...")
+            with stage_metrics.track("llm_call"):
+                response = await async_client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=[{"role": "user", "content": prompt}],
+                    temperature=0.8,
+                    **extra
+                )
+        print("[v0] OpenAI API call successful")
+        return response
+    except Exception as e:
+        print(f"[v0] OpenAI API error: {e}")
+        return None
+
+def build_outline_prompt(topic: str, slides: int, university: str, student_name: str, from_to: str):
+    num_content_slides = slides - 3
     
-    template = random.choice(templates)
-    random.seed()
-    return template
+    prompt = f"""
+Mavzu: "{topic}" haqida {slides} ta slaydli professional taqdimot REJASINI tuzing. Barcha matn O'ZBEK TILIDA bo'lishi kerak.
+
+Sarlavha, kirish va xulosa slaydlarini to'liq yozing, asosiy qism uchun esa AYNAN {num_content_slides} ta bo'lim sarlavhasini bering.
+Bo'limlar takrorlanmasin va mantiqiy tartibda bo'lsin. Har bir slayd uchun 2-3 ta topic-relevant image_prompts yarating.
+
+JSON obyekt qaytaring (faqat JSON, boshqa hech narsa yo'q):
+{{
+  "title": {{
+    "type": "title",
+    "title": "{topic}",
+    "university": "{university}",
+    "student": "{student_name}",
+    "from_to": "{from_to}",
+    "image_prompts": ["{topic} professional background", "{topic} concept visualization"]
+  }},
+  "introduction": {{
+    "type": "introduction",
+    "title": "Kirish va Reja",
+    "content": "Qisqa kirish matni (30-40 so'z).",
+    "outline": ["Birinchi bo'lim - qisqa", "Ikkinchi bo'lim - qisqa", "Uchinchi bo'lim - qisqa", "To'rtinchi bo'lim - qisqa"],
+    "image_prompts": ["{topic} introduction concept", "{topic} overview diagram"]
+  }},
+  "sections": ["1-bo'lim sarlavhasi", "2-bo'lim sarlavhasi"],
+  "conclusion": {{
+    "type": "conclusion",
+    "title": "Xulosa",
+    "summary": "Qisqa xulosa matni (40-50 so'z).",
+    "takeaways": ["Birinchi xulosa - qisqa", "Ikkinchi xulosa - qisqa", "Uchinchi xulosa - qisqa"],
+    "image_prompts": ["{topic} success concept", "{topic} summary"]
+  }}
+}}
+
+ESLATMA: "sections" ro'yxatida AYNAN {num_content_slides} ta sarlavha bo'lsin.
+
+Faqat to'g'ri JSON qaytaring, qo'shimcha matn yoki kod bloklarsiz.
+"""
+    return prompt
+
+def build_section_prompt(topic: str, section_titles):
+    titles = "\n".join(f"{i + 1}. {title}" for i, title in enumerate(section_titles))
+    
+    prompt = f"""
+Mavzu: "{topic}" haqidagi taqdimot uchun quyidagi {len(section_titles)} ta kontent slaydini yarating. Barcha matn O'ZBEK TILIDA bo'lishi kerak.
+
+Slaydlar (aynan shu tartibda va shu sarlavhalar bilan):
+{titles}
+
+Har bir slayd uchun QISQA va ANIQ ma'lumot bering:
+1. Har bir slaydda 4 ta nuqta, har bir nuqta 10-12 so'zdan oshmasin (MUHIM!)
+2. Oddiy va tushunarli til ishlatilsin
+3. Har bir slayd uchun 2-3 ta topic-relevant image_prompts yarating
+
+JSON array qaytaring (faqat JSON, boshqa hech narsa yo'q):
+[
+  {{
+    "type": "content",
+    "title": "Bo'lim sarlavhasi",
+    "layout_type": "bullet_points",
+    "points": [
+      "Birinchi nuqta - 10-12 so'z",
+      "Ikkinchi nuqta - 10-12 so'z",
+      "Uchinchi nuqta - 10-12 so'z",
+      "To'rtinchi nuqta - 10-12 so'z"
+    ],
+    "image_prompts": ["{topic} detailed diagram", "{topic} example"]
+  }}
+]
+
+ESLATMA: Aynan {len(section_titles)} ta slayd qaytaring.
+
+Faqat to'g'ri JSON qaytaring, qo'shimcha matn yoki kod bloklarsiz.
+"""
+    return prompt
+
+async def generate_section_batch(topic: str, section_titles):
+    """Generate content slides for one batch of outline sections, retrying the batch once"""
+    for attempt in range(2):
+        response = await request_completion(build_section_prompt(topic, section_titles), structured(SLIDES_RESPONSE_FORMAT))
+        if response is not None:
+            batch = parse_slide_response(response)
+            if isinstance(batch, list) and batch:
+                return [slide_data for slide_data in batch if isinstance(slide_data, dict)][:len(section_titles)]
+        print(f"[v0] Section batch failed (attempt {attempt + 1}): {section_titles[0]}...")
+    return []
+
+async def generate_slide_content_planned(topic: str, slides: int, university: str, student_name: str, from_to: str):
+    """Generate the outline first, then the content slides in concurrent batches, merged in order"""
+    response = await request_completion(build_outline_prompt(topic, slides, university, student_name, from_to), structured(OUTLINE_RESPONSE_FORMAT))
+    outline = parse_slide_response(response) if response is not None else None
+    if not isinstance(outline, dict) or not all(key in outline for key in ("title", "introduction", "conclusion")):
+        print("[v0] Outline generation failed")
+        return []
+    
+    sections = [str(title) for title in outline.get("sections", [])][:slides - 3]
+    batches = [sections[i:i + PLANNER_BATCH_SIZE] for i in range(0, len(sections), PLANNER_BATCH_SIZE)]
+    print(f"[v0] Outline ready: {len(sections)} sections in {len(batches)} batches")
+    results = await asyncio.gather(*(generate_section_batch(topic, batch) for batch in batches))
+    
+    content_slides = [slide_data for batch in results for slide_data in batch]
+    print(f"[v0] Planned generation produced {len(content_slides)}/{len(sections)} content slides")
+    return [outline["title"], outline["introduction"]] + content_slides + [outline["conclusion"]]
+
+def use_planner(slides):
+    """Chunk generation when the deck is long or one completion would likely be truncated"""
+    return slides >= PLANNER_MIN_SLIDES or slides * SLIDE_TOKENS > LLM_MAX_COMPLETION_TOKENS
+
+def estimate_deck_cost(slides):
+    """Rough token and render-time cost of a deck, used to admit or refuse a request up front"""
+    completion_tokens = slides * SLIDE_TOKENS
+    requests_made = 1
+    if use_planner(slides):
+        # Outline call plus one call per batch of content slides, each with its own prompt
+        requests_made += -(-(slides - 3) // PLANNER_BATCH_SIZE)
+    return {
+        "tokens": requests_made * PROMPT_TOKENS + completion_tokens,
+        "requests": requests_made,
+        "render_seconds": slides * RENDER_SECONDS_PER_SLIDE,
+    }
+
+def admission_error(slides):
+    """Uzbek message explaining why a deck of this size is refused, or None to admit it"""
+    if slides < MIN_SLIDES:
+        return f"Kamida {MIN_SLIDES} ta slayd bo'lishi kerak (sarlavha, kirish, kontent, xulosa). Qaytadan kiriting:"
+    if slides > MAX_SLIDES:
+        return f"Ko'pi bilan {MAX_SLIDES} ta slayd tayyorlash mumkin. Qaytadan kiriting:"
+    cost = estimate_deck_cost(slides)
+    if cost["tokens"] > MAX_DECK_TOKENS or cost["render_seconds"] > MAX_RENDER_SECONDS:
+        print(f"[v0] Refusing {slides}-slide deck: {cost}")
+        return "Bu hajmdagi taqdimot juda katta. Iltimos, kamroq slayd sonini kiriting:"
+    return None
+
+async def fix_slide(topic, slide_data, university, student_name, from_to):
+    """Return slide_data if it validates, otherwise a regenerated copy from one single-slide request"""
+    if isinstance(slide_data, dict) and slide_data.get("type") == "title":
+        return fill_title_slide(slide_data, topic, university, student_name, from_to)
+    errors = validate_slide(slide_data)
+    if not errors:
+        return slide_data
+    print(f"[v0] Regenerating invalid slide '{slide_data.get('title', '')}': {errors}")
+    slide_type = slide_type_of(slide_data)
+    response = await request_completion(build_slide_fix_prompt(topic, slide_data, errors), structured(SLIDE_RESPONSE_FORMATS[slide_type]))
+    return fixed_slide(slide_data, response)
+
+async def generate_slide_content(topic: str, slides: int, university: str, student_name: str, from_to: str):
+    if use_planner(slides):
+        content = await generate_slide_content_planned(topic, slides, university, student_name, from_to)
+    else:
+        response = await request_completion(build_slide_prompt(topic, slides, university, student_name, from_to), structured(SLIDES_RESPONSE_FORMAT))
+        if response is None:
+            return []
+        content = parse_slide_response(response)
+    if needs_completion(content, slides):
+        # Ask only for what is missing instead of throwing the salvaged slides away; planned decks
+        # come back short too, when a batch fails or the outline has fewer sections
+        print(f"[v0] Requesting missing slides: {missing_slides(content, slides)}")
+        response = await request_completion(build_missing_slides_prompt(topic, content, slides), structured(SLIDES_RESPONSE_FORMAT))
+        extra = parse_slide_response(response) if response is not None else []
+        content = content + (extra if isinstance(extra, list) else [])
+    if not isinstance(content, list) or not content:
+        return []
+    
+    # Wrong counts are settled by assembling; broken slides are regenerated one by one
+    content = assemble_slides(content, slides, topic, university, student_name, from_to)
+    return list(await asyncio.gather(*(fix_slide(topic, slide_data, university, student_name, from_to) for slide_data in content)))
+
+TITLE_FIELDS = ("university", "student", "from_to")
+
+async def run_blocking(fn, *args):
+    """Run a blocking SQLite call (caches, broker) in the default executor, off the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+def normalize_topic(topic):
+    return re.sub(r"\s+", " ", topic).strip().strip(".!?,;:").casefold()
+
+def content_cache_key(topic, slides):
+    return hashlib.sha256(f"{normalize_topic(topic)}\x00{slides}".encode("utf-8")).hexdigest()
+
+def get_content_cache_db():
+    global content_cache_db
+    if content_cache_db is None:
+        content_cache_db = sqlite3.connect(CONTENT_CACHE_PATH, check_same_thread=False)
+        content_cache_db.execute(
+            "CREATE TABLE IF NOT EXISTS content_cache ("
+            "key TEXT PRIMARY KEY, topic TEXT, slides INTEGER, content TEXT, created REAL, last_used REAL)"
+        )
+        content_cache_db.execute("CREATE INDEX IF NOT EXISTS content_cache_last_used ON content_cache (last_used)")
+        content_cache_db.execute("CREATE TABLE IF NOT EXISTS telegram_files (hash TEXT PRIMARY KEY, file_id TEXT, last_used REAL)")
+        content_cache_db.execute("CREATE INDEX IF NOT EXISTS telegram_files_last_used ON telegram_files (last_used)")
+        content_cache_db.commit()
+    return content_cache_db
+
+def strip_title_fields(content):
+    """Copy of the slides with the per-user title-slide fields blanked out"""
+    generic = []
+    for slide_data in content:
+        slide_data = dict(slide_data)
+        if slide_data.get("type") == "title":
+            for field in TITLE_FIELDS:
+                slide_data[field] = ""
+        generic.append(slide_data)
+    return generic
+
+def apply_title_fields(content, university, student_name, from_to):
+    """Copy of the slides with this user's fields on the title slide"""
+    fields = {"university": university, "student": student_name, "from_to": from_to}
+    personal = []
+    for slide_data in content:
+        if slide_data.get("type") == "title":
+            slide_data = {**slide_data, **fields}
+        personal.append(slide_data)
+    return personal
+
+def content_cache_get(topic, slides):
+    """Return cached generic slides for (topic, slides), or None on a miss or expired entry"""
+    if not CONTENT_CACHE_ENABLED:
+        return None
+    key = content_cache_key(topic, slides)
+    now = time.time()
+    try:
+        with content_cache_lock:
+            db = get_content_cache_db()
+            row = db.execute("SELECT content, created FROM content_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > CONTENT_CACHE_TTL:
+                db.execute("DELETE FROM content_cache WHERE key = ?", (key,))
+                db.commit()
+                content_cache_stats["expired"] += 1
+                row = None
+            if row is None:
+                content_cache_stats["misses"] += 1
+                return None
+            db.execute("UPDATE content_cache SET last_used = ? WHERE key = ?", (now, key))
+            db.commit()
+            content_cache_stats["hits"] += 1
+        return json.loads(row[0])
+    except Exception as e:
+        print(f"[v0] Content cache read error: {e}")
+        return None
+
+def content_cache_put(topic, slides, content):
+    """Store generic slides for (topic, slides) and evict least recently used entries past the limit"""
+    if not CONTENT_CACHE_ENABLED:
+        return
+    key = content_cache_key(topic, slides)
+    now = time.time()
+    try:
+        with content_cache_lock:
+            db = get_content_cache_db()
+            db.execute(
+                "INSERT OR REPLACE INTO content_cache (key, topic, slides, content, created, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, normalize_topic(topic), slides, json.dumps(strip_title_fields(content), ensure_ascii=False), now, now)
+            )
+            db.execute(
+                "DELETE FROM content_cache WHERE key NOT IN (SELECT key FROM content_cache ORDER BY last_used DESC LIMIT ?)",
+                (CONTENT_CACHE_MAX_ENTRIES,)
+            )
+            db.commit()
+    except Exception as e:
+        print(f"[v0] Content cache write error: {e}")
+
+def content_fingerprint(content):
+    return hashlib.sha256(json.dumps(content, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def pptx_content_hash(ppt_bytes):
+    """Hash of the PPTX parts rather than the zip, whose member timestamps change on every save"""
+    digest = hashlib.sha256()
+    with zipfile.ZipFile(BytesIO(ppt_bytes)) as archive:
+        for name in sorted(archive.namelist()):
+            digest.update(name.encode("utf-8") + b"\x00")
+            digest.update(archive.read(name))
+    return digest.hexdigest()
+
+def telegram_file_get(digest):
+    """Telegram file_id of an already uploaded deck with this content hash, or None"""
+    if not FILE_ID_CACHE_ENABLED:
+        return None
+    try:
+        with content_cache_lock:
+            db = get_content_cache_db()
+            row = db.execute("SELECT file_id FROM telegram_files WHERE hash = ?", (digest,)).fetchone()
+            if row is not None:
+                db.execute("UPDATE telegram_files SET last_used = ? WHERE hash = ?", (time.time(), digest))
+                db.commit()
+        return row[0] if row is not None else None
+    except Exception as e:
+        print(f"[v0] File id cache read error: {e}")
+        return None
+
+def telegram_file_put(digest, file_id):
+    if not FILE_ID_CACHE_ENABLED:
+        return
+    try:
+        with content_cache_lock:
+            db = get_content_cache_db()
+            db.execute("INSERT OR REPLACE INTO telegram_files (hash, file_id, last_used) VALUES (?, ?, ?)", (digest, file_id, time.time()))
+            db.execute(
+                "DELETE FROM telegram_files WHERE hash NOT IN (SELECT hash FROM telegram_files ORDER BY last_used DESC LIMIT ?)",
+                (FILE_ID_CACHE_MAX_ENTRIES,)
+            )
+            db.commit()
+    except Exception as e:
+        print(f"[v0] File id cache write error: {e}")
+
+class SlideStreamParser:
+    """Incrementally pull complete slide objects out of a streamed JSON array (possibly wrapped)"""
+
+    def __init__(self, item_depth=1):
+        # 1 for a bare array, 2 for the {"slides": [...]} wrapper of structured output
+        self.item_depth = item_depth
+        self.buffer = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.object_start = None
+
+    def feed(self, text):
+        self.buffer += text
+        slides = []
+        while self.pos < len(self.buffer):
+            char = self.buffer[self.pos]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = self.depth > 0
+            elif char in "[{":
+                if self.depth == self.item_depth and char == "{":
+                    self.object_start = self.pos
+                self.depth += 1
+            elif char in "]}":
+                self.depth -= 1
+                if self.depth == self.item_depth and char == "}" and self.object_start is not None:
+                    text = self.buffer[self.object_start:self.pos + 1]
+                    try:
+                        with stage_metrics.track("json_parse"):
+                            slides.append(json.loads(text))
+                    except Exception:
+                        try:
+                            slides.append(json.loads(strip_trailing_commas(text)))
+                        except Exception as e:
+                            print(f"[v0] Skipping malformed streamed slide: {e}")
+                    self.buffer = self.buffer[self.pos + 1:]
+                    self.pos = -1
+                    self.object_start = None
+            self.pos += 1
+        if self.object_start is None and self.depth <= self.item_depth:
+            self.buffer = ""
+            self.pos = 0
+        return slides
+
+async def stream_slide_content(topic: str, slides: int, university: str, student_name: str, from_to: str):
+    """Yield each slide object as soon as the model closes it"""
+    prompt = build_slide_prompt(topic, slides, university, student_name, from_to)
+    response_format = structured(SLIDES_RESPONSE_FORMAT)
+    parser = SlideStreamParser(item_depth=2 if response_format is not None else 1)
+    extra = {"response_format": response_format} if response_format is not None else {}
+
+    try:
+        async with llm_semaphore:
+            print("[v0] Streaming OpenAI content generation...")
+            # Spans the whole stream, including the time slides spend being handed to the renderer
+            with stage_metrics.track("llm_call"):
+                stream = await async_client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=[{"role": "user", "content": prompt}],
+                    temperature=0.8,
+                    stream=True,
+                    **extra
+                )
+                async for chunk in stream:
+                    if not chunk.choices or not chunk.choices[0].delta.content:
+                        continue
+                    for slide_data in parser.feed(chunk.choices[0].delta.content):
+                        yield slide_data
+        print("[v0] OpenAI stream finished")
+    except Exception as e:
+        print(f"[v0] OpenAI streaming error: {e}")
+
+BUILTIN_TEMPLATES = [
+    # Minimalist Modern Series
+    {
+        "name": "Arctic Minimalist",
+        "bg_color": RGBColor(255, 255, 255),
+        "primary": RGBColor(10, 10, 10),
+        "accent": RGBColor(0, 122, 255),
+        "text_primary": RGBColor(10, 10, 10),
+        "text_secondary": RGBColor(100, 100, 100),
+        "shape_fill": RGBColor(248, 249, 250),
+        "shape_text": RGBColor(10, 10, 10),  # Dark text on light shape
+        "shape_border": RGBColor(0, 122, 255),
+        "gradient_start": RGBColor(240, 248, 255),
+        "gradient_end": RGBColor(255, 255, 255),
+        "title_font_size": 52,
+        "subtitle_font_size": 26,
+        "content_font_size": 18,
+        "style": "minimalist"
+    },
+    {
+        "name": "Dark Mode Elite",
+        "bg_color": RGBColor(18, 18, 18),
+        "primary": RGBColor(0, 229, 255),
+        "accent": RGBColor(138, 43, 226),
+        "text_primary": RGBColor(255, 255, 255),
+        "text_secondary": RGBColor(200, 200, 200),
+        "shape_fill": RGBColor(30, 30, 30),
+        "shape_text": RGBColor(255, 255, 255),  # Light text on dark shape
+        "shape_border": RGBColor(0, 229, 255),
+        "gradient_start": RGBColor(25, 25, 35),
+        "gradient_end": RGBColor(18, 18, 18),
+        "title_font_size": 50,
+        "subtitle_font_size": 25,
+        "content_font_size": 17,
+        "style": "dark_modern"
+    },
+    {
+        "name": "Professional Blue",
+        "bg_color": RGBColor(245, 248, 252),
+        "primary": RGBColor(25, 118, 210),
+        "accent": RGBColor(66, 165, 245),
+        "text_primary": RGBColor(13, 71, 161),
+        "text_secondary": RGBColor(25, 118, 210),
+        "shape_fill": RGBColor(255, 255, 255),
+        "shape_text": RGBColor(13, 71, 161),  # Dark blue text on white
+        "shape_border": RGBColor(66, 165, 245),
+        "gradient_start": RGBColor(227, 242, 253),
+        "gradient_end": RGBColor(245, 248, 255),
+        "title_font_size": 48,
+        "subtitle_font_size": 24,
+        "content_font_size": 17,
+        "style": "corporate"
+    },
+    {
+        "name": "Emerald Business",
+        "bg_color": RGBColor(255, 255, 255),
+        "primary": RGBColor(0, 105, 92),
+        "accent": RGBColor(0, 200, 83),
+        "text_primary": RGBColor(0, 77, 64),
+        "text_secondary": RGBColor(69, 90, 100),
+        "shape_fill": RGBColor(232, 245, 233),
+        "shape_text": RGBColor(0, 77, 64),  # Dark green text on light green
+        "shape_border": RGBColor(0, 105, 92),
+        "gradient_start": RGBColor(232, 245, 233),
+        "gradient_end": RGBColor(255, 255, 255),
+        "title_font_size": 48,
+        "subtitle_font_size": 24,
+        "content_font_size": 17,
+        "style": "corporate"
+    },
+    {
+        "name": "Ocean Depth",
+        "bg_color": RGBColor(240, 248, 255),
+        "primary": RGBColor(0, 105, 148),
+        "accent": RGBColor(0, 188, 212),
+        "text_primary": RGBColor(1, 87, 155),
+        "text_secondary": RGBColor(38, 50, 56),
+        "shape_fill": RGBColor(255, 255, 255),
+        "shape_text": RGBColor(1, 87, 155),  # Dark blue text on white
+        "shape_border": RGBColor(0, 188, 212),
+        "gradient_start": RGBColor(224, 247, 250),
+        "gradient_end": RGBColor(240, 248, 255),
+        "title_font_size": 48,
+        "subtitle_font_size": 24,
+        "content_font_size": 17,
+        "style": "nature_modern"
+    },
+    {
+        "name": "Forest Canopy",
+        "bg_color": RGBColor(249, 251, 248),
+        "primary": RGBColor(27, 94, 32),
+        "accent": RGBColor(76, 175, 80),
+        "text_primary": RGBColor(27, 94, 32),
+        "text_secondary": RGBColor(56, 142, 60),
+        "shape_fill": RGBColor(255, 255, 255),
+        "shape_text": RGBColor(27, 94, 32),  # Dark green text on white
+        "shape_border": RGBColor(76, 175, 80),
+        "gradient_start": RGBColor(232, 245, 233),
+        "gradient_end": RGBColor(249, 251, 248),
+        "title_font_size": 48,
+        "subtitle_font_size": 24,
+        "content_font_size": 17,
+        "style": "nature_modern"
+    },
+    {
+        "name": "Sunset Gradient",
+        "bg_color": RGBColor(255, 250, 245),
+        "primary": RGBColor(211, 47, 47),
+        "accent": RGBColor(255, 152, 0),
+        "text_primary": RGBColor(183, 28, 28),
+        "text_secondary": RGBColor(191, 54, 12),
+        "shape_fill": RGBColor(255, 255, 255),
+        "shape_text": RGBColor(183, 28, 28),  # Dark red text on white
+        "shape_border": RGBColor(255, 152, 0),
+        "gradient_start": RGBColor(255, 245, 238),
+        "gradient_end": RGBColor(255, 250, 245),
+        "title_font_size": 50,
+        "subtitle_font_size": 26,
+        "content_font_size": 18,
+        "style": "gradient_bold"
+    },
+    {
+        "name": "Royal Purple",
+        "bg_color": RGBColor(248, 245, 255),
+        "primary": RGBColor(94, 53, 177),
+        "accent": RGBColor(156, 39, 176),
+        "text_primary": RGBColor(74, 20, 140),
+        "text_secondary": RGBColor(106, 27, 154),
+        "shape_fill": RGBColor(255, 255, 255),
+        "shape_text": RGBColor(74, 20, 140),  # Dark purple text on white
+        "shape_border": RGBColor(156, 39, 176),
+        "gradient_start": RGBColor(237, 231, 246),
+        "gradient_end": RGBColor(248, 245, 255),
+        "title_font_size": 50,
+        "subtitle_font_size": 25,
+        "content_font_size": 17,
+        "style": "creative"
+    },
+    {
+        "name": "Monochrome Pro",
+        "bg_color": RGBColor(255, 255, 255),
+        "primary": RGBColor(33, 33, 33),
+        "accent": RGBColor(117, 117, 117),
+        "text_primary": RGBColor(33, 33, 33),
+        "text_secondary": RGBColor(97, 97, 97),
+        "shape_fill": RGBColor(245, 245, 245),
+        "shape_text": RGBColor(33, 33, 33),  # Dark text on light gray
+        "shape_border": RGBColor(33, 33, 33),
+        "gradient_start": RGBColor(245, 245, 245),
+        "gradient_end": RGBColor(255, 255, 255),
+        "title_font_size": 50,
+        "subtitle_font_size": 25,
+        "content_font_size": 17,
+        "style": "monochrome"
+    },
+    {
+        "name": "Charcoal Elegance",
+        "bg_color": RGBColor(250, 250, 250),
+        "primary": RGBColor(55, 71, 79),
+        "accent": RGBColor(96, 125, 139),
+        "text_primary": RGBColor(38, 50, 56),
+        "text_secondary": RGBColor(69, 90, 100),
+        "shape_fill": RGBColor(255, 255, 255),
+        "shape_text": RGBColor(38, 50, 56),  # Dark text on white
+        "shape_border": RGBColor(96, 125, 139),
+        "gradient_start": RGBColor(236, 239, 241),
+        "gradient_end": RGBColor(250, 250, 250),
+        "title_font_size": 48,
+        "subtitle_font_size": 24,
+        "content_font_size": 17,
+        "style": "monochrome"
+    }
+]
+
+def compile_template(raw):
+    """Turn a template mapping into an immutable one, accepting "#RRGGBB" or [r, g, b] colours"""
+    template = {}
+    for key, value in raw.items():
+        if isinstance(value, str) and value.startswith("#") and len(value) == 7:
+            value = RGBColor.from_string(value[1:].upper())
+        elif isinstance(value, (list, tuple)) and len(value) == 3 and all(isinstance(v, int) for v in value):
+            value = RGBColor(*value)
+        template[key] = value
+    return MappingProxyType(template)
+
+def load_design_templates(path):
+    """Load templates from a JSON or TOML file: a list, or a mapping with a "templates" list"""
+    with open(path, "rb") as f:
+        if path.endswith(".toml"):
+            if tomllib is None:
+                raise RuntimeError("TOML templates need Python 3.11+")
+            data = tomllib.load(f)
+        else:
+            data = json.load(f)
+    if isinstance(data, dict):
+        data = data.get("templates", [])
+    return [compile_template(raw) for raw in data]
+
+DESIGN_TEMPLATES = tuple(load_design_templates(TEMPLATE_FILE) if TEMPLATE_FILE else map(compile_template, BUILTIN_TEMPLATES))
+TEMPLATES_BY_NAME = MappingProxyType({template["name"]: template for template in DESIGN_TEMPLATES})
+TEMPLATES_BY_STYLE = MappingProxyType({
+    style: tuple(template for template in DESIGN_TEMPLATES if template["style"] == style)
+    for style in {template["style"] for template in DESIGN_TEMPLATES}
+})
+
+def get_advanced_design_template(seed=None, name=None, style=None, rng=None):
+    """Pick a template from the registry by name, or randomly (optionally within a style)
+
+    Uses rng or a local random.Random(seed), so the global RNG is never reseeded.
+    """
+    if name is not None:
+        return TEMPLATES_BY_NAME[name]
+    candidates = TEMPLATES_BY_STYLE.get(style) if style is not None else DESIGN_TEMPLATES
+    if not candidates:
+        candidates = DESIGN_TEMPLATES
+    if rng is None:
+        rng = random.Random(seed)
+    return rng.choice(candidates)
+
+def add_slide_image(slide_obj, image_bytes, transparency=0.85):
+    """Place a generated image as a faded, cropped full-slide backdrop behind the content"""
+    try:
+        picture = slide_obj.shapes.add_picture(BytesIO(image_bytes), Inches(0), Inches(0), Inches(10), Inches(7.5))
+        
+        img_width, img_height = picture.image.size
+        slide_ratio = 10 / 7.5
+        img_ratio = img_width / img_height
+        if img_ratio > slide_ratio:
+            crop = (1 - slide_ratio / img_ratio) / 2
+            picture.crop_left = crop
+            picture.crop_right = crop
+        elif img_ratio < slide_ratio:
+            crop = (1 - img_ratio / slide_ratio) / 2
+            picture.crop_top = crop
+            picture.crop_bottom = crop
+        
+        alpha = OxmlElement('a:alphaModFix')
+        alpha.set('amt', str(int((1 - transparency) * 100000)))
+        picture._element.blipFill.find(qn('a:blip')).append(alpha)
+        
+        # Send to back so images that arrive after the slide was rendered still sit behind it
+        sp_tree = slide_obj.shapes._spTree
+        sp_tree.remove(picture._element)
+        sp_tree.insert(2, picture._element)
+    except Exception as e:
+        print(f"[v0] Could not place slide image: {e}")
 
 def add_modern_decorative_element(slide_obj, template, position="top"):
     """Add ultra-modern decorative elements with 2025 design trends"""
@@ -489,908 +1610,1100 @@ def add_geometric_decoration(slide_obj, template, style="circles"):
         triangle.line.fill.background()
         triangle.fill.transparency = 0.4
 
-async def create_ppt(content, filename="presentation.pptx"):
-    print(f"[v0] Starting READABLE PPT creation with {len(content)} slides")
+def render_context():
+    """Start render processes from a clean interpreter rather than forking the threaded bot
+
+    A fork can inherit locks held by the image, executor or metrics threads (even the one behind
+    print) and deadlock the child; forkserver avoids that where the platform has it.
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(method)
+
+def get_render_pool():
+    """Lazily start the process pool that renders decks off the event loop"""
+    global render_pool
+    if render_pool is None:
+        print(f"[v0] Starting render pool with {RENDER_WORKERS} workers")
+        render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=render_context())
+    return render_pool
+
+def get_stream_render_pool():
+    """Lazily start the pool for streamed decks, whose workers mostly wait on the LLM
+
+    Kept apart from the render pool so cache-hit and batch renders never queue behind a stream.
+    """
+    global stream_render_pool
+    if stream_render_pool is None:
+        print(f"[v0] Starting stream render pool with {STREAM_RENDER_WORKERS} workers")
+        stream_render_pool = ProcessPoolExecutor(max_workers=STREAM_RENDER_WORKERS, mp_context=render_context())
+    return stream_render_pool
+
+def get_render_manager():
+    """Lazily start the manager that provides queues for streaming slides into render workers"""
+    global render_manager
+    if render_manager is None:
+        render_manager = render_context().Manager()
+    return render_manager
+
+async def shutdown_pools(app=None):
+    global render_pool, stream_render_pool, render_manager, metrics_server
+    deck_queue.stop()
+    conversations.close()
+    if render_pool is not None:
+        render_pool.shutdown(wait=False, cancel_futures=True)
+        render_pool = None
+    if stream_render_pool is not None:
+        stream_render_pool.shutdown(wait=False, cancel_futures=True)
+        stream_render_pool = None
+    if render_manager is not None:
+        render_manager.shutdown()
+        render_manager = None
+    image_pool.shutdown(wait=False, cancel_futures=True)
+    http_session.close()
+    await async_client.close()
+    if content_cache_db is not None:
+        content_cache_db.close()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+        metrics_server = None
+
+def set_theme_colors(master, template):
+    """Point the master's theme colour scheme at the template palette"""
+    theme_part = master.part.part_related_by(RT.THEME)
+    theme = etree.fromstring(theme_part.blob)
+    scheme = theme.find(qn('a:themeElements')).find(qn('a:clrScheme'))
+    scheme.set('name', template['name'])
+    colors = {
+        "dk1": template['text_primary'],
+        "lt1": template['bg_color'],
+        "dk2": template['primary'],
+        "lt2": template['shape_fill'],
+        "accent1": template['primary'],
+        "accent2": template['accent'],
+    }
+    for tag, color in colors.items():
+        slot = scheme.find(qn(f'a:{tag}'))
+        for child in list(slot):
+            slot.remove(child)
+        etree.SubElement(slot, qn('a:srgbClr')).set('val', str(color))
+    theme_part._blob = etree.tostring(theme, xml_declaration=True, encoding="UTF-8", standalone=True)
+
+def build_template_base(template):
+    """Bake the template's background, accent bar, corner circle and theme into the master and Blank layout"""
     prs = Presentation()
     prs.slide_width = Inches(10)
     prs.slide_height = Inches(7.5)
+    master = prs.slide_master
+    layout = prs.slide_layouts[6]
     
-    design_seed = random.randint(1, 1000000)
-    template = get_advanced_design_template(design_seed)
-    print(f"[v0] Using READABLE design template: {template['name']} ({template['style']})")
+    for base in (master, layout):
+        base.background.fill.solid()
+        base.background.fill.fore_color.rgb = template['bg_color']
+    set_theme_colors(master, template)
     
-    layout_types = ["cards", "two_column", "timeline", "comparison", "grid", "numbered", "highlight", "icon_based"]
-    used_layouts = []
+    # Layout shape collections have no add_shape, so draw the chrome on a scratch slide and move it over
+    scratch = prs.slides.add_slide(layout)
     
-    for idx, slide_data in enumerate(content):
-        print(f"[v0] Creating readable slide {idx + 1}/{len(content)}")
-        slide_type = slide_data.get("type", "content")
-        
-        slide_layout = prs.slide_layouts[6]
-        slide_obj = prs.slides.add_slide(slide_layout)
+    top_accent = scratch.shapes.add_shape(
+        MSO_SHAPE.ROUNDED_RECTANGLE,
+        Inches(0), Inches(0), Inches(10), Inches(0.25)
+    )
+    top_accent.fill.solid()
+    top_accent.fill.fore_color.rgb = template['primary']
+    top_accent.line.fill.background()
+    
+    corner_circle = scratch.shapes.add_shape(
+        MSO_SHAPE.OVAL,
+        Inches(9.3), Inches(7), Inches(0.5), Inches(0.5)
+    )
+    corner_circle.fill.solid()
+    corner_circle.fill.fore_color.rgb = template['accent']
+    corner_circle.line.fill.background()
+    corner_circle.fill.transparency = 0.3
+    
+    # Shape ids are per part; the scratch slide's ids clash with the layout's own placeholders
+    layout_tree = layout.shapes._spTree
+    for shape in (top_accent, corner_circle):
+        shape._element.nvSpPr.cNvPr.id = layout.shapes._next_shape_id
+        layout_tree.append(shape._element)
+    
+    scratch_id = prs.slides._sldIdLst[-1]
+    prs.part.drop_rel(scratch_id.rId)
+    prs.slides._sldIdLst.remove(scratch_id)
+    
+    output = BytesIO()
+    prs.save(output)
+    return output.getvalue()
 
-        background = slide_obj.background
-        fill = background.fill
-        fill.solid()
-        fill.fore_color.rgb = template['bg_color']
+def new_presentation(template):
+    """Start a deck from the template's cached base presentation, building it on first use"""
+    base = template_base_cache.get(template['name'])
+    if base is None:
+        print(f"[v0] Building base presentation for template: {template['name']}")
+        base = build_template_base(template)
+        template_base_cache[template['name']] = base
+    return Presentation(BytesIO(base))
 
-        top_accent = slide_obj.shapes.add_shape(
-            MSO_SHAPE.ROUNDED_RECTANGLE,
-            Inches(0), Inches(0), Inches(10), Inches(0.25)
-        )
-        top_accent.fill.solid()
-        top_accent.fill.fore_color.rgb = template['primary']
-        top_accent.line.fill.background()
-        
-        corner_circle = slide_obj.shapes.add_shape(
-            MSO_SHAPE.OVAL,
-            Inches(9.3), Inches(7), Inches(0.5), Inches(0.5)
-        )
-        corner_circle.fill.solid()
-        corner_circle.fill.fore_color.rgb = template['accent']
-        corner_circle.line.fill.background()
-        corner_circle.fill.transparency = 0.3
+def save_presentation(prs):
+    output = BytesIO()
+    with stage_metrics.track("save"):
+        prs.save(output)
+    print(f"[v0] READABLE presentation rendered ({output.tell()} bytes)")
+    return output.getvalue()
 
-        image_prompts = slide_data.get("image_prompts", [])
-        
-        try:
-            if slide_type == "title":
-                title_box = slide_obj.shapes.add_shape(
-                    MSO_SHAPE.ROUNDED_RECTANGLE,
-                    Inches(0.5), Inches(0.6), Inches(9), Inches(1.1)
-                )
-                title_box.fill.solid()
-                title_box.fill.fore_color.rgb = RGBColor(255, 255, 255)
-                title_box.line.color.rgb = template['primary']
-                title_box.line.width = Pt(8)
-                add_advanced_shadow(title_box, blur=15, distance=8, transparency=0.25)
-                
-                title_frame = title_box.text_frame
-                title_frame.word_wrap = True
-                title_frame.margin_left = Inches(0.3)
-                title_frame.margin_right = Inches(0.3)
-                title_frame.margin_top = Inches(0.15)
-                title_frame.margin_bottom = Inches(0.15)
-                title_frame.text = slide_data.get("title", "")
-                title_p = title_frame.paragraphs[0]
-                title_p.font.size = Pt(42)
-                title_p.font.bold = True
-                title_p.font.color.rgb = template['primary']  # Dark text on white box
-                title_p.alignment = PP_ALIGN.CENTER
-                title_p.line_spacing = 1.1
-                title_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                
-                uni_box = slide_obj.shapes.add_shape(
-                    MSO_SHAPE.ROUNDED_RECTANGLE,
-                    Inches(1), Inches(2.1), Inches(8), Inches(1.8)
-                )
-                uni_box.fill.solid()
-                uni_box.fill.fore_color.rgb = template['shape_fill']
-                uni_box.line.color.rgb = template['accent']
-                uni_box.line.width = Pt(5)
-                add_advanced_shadow(uni_box, blur=12, distance=6, transparency=0.2)
-                
-                uni_frame = uni_box.text_frame
-                uni_frame.word_wrap = True
-                uni_frame.margin_left = Inches(0.4)
-                uni_frame.margin_right = Inches(0.4)
-                uni_frame.margin_top = Inches(0.25)
-                uni_frame.margin_bottom = Inches(0.25)
-                uni_frame.text = slide_data.get("university", "")
-                uni_p = uni_frame.paragraphs[0]
-                uni_p.font.size = Pt(20)
-                uni_p.font.bold = True
-                uni_p.font.color.rgb = template['shape_text']  # Use shape_text for proper contrast
-                uni_p.alignment = PP_ALIGN.CENTER
-                uni_p.line_spacing = 1.2
-                uni_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                
-                student_card = slide_obj.shapes.add_shape(
-                    MSO_SHAPE.ROUNDED_RECTANGLE,
-                    Inches(0.8), Inches(4.5), Inches(4.2), Inches(1.5)
-                )
-                student_card.fill.solid()
-                student_card.fill.fore_color.rgb = RGBColor(255, 255, 255)
-                student_card.line.color.rgb = template['accent']
-                student_card.line.width = Pt(5)
-                add_advanced_shadow(student_card, blur=10, distance=5, transparency=0.2)
-                
-                student_icon = slide_obj.shapes.add_shape(
-                    MSO_SHAPE.OVAL,
-                    Inches(1.2), Inches(4.8), Inches(0.9), Inches(0.9)
-                )
-                student_icon.fill.solid()
-                student_icon.fill.fore_color.rgb = template['primary']
-                student_icon.line.fill.background()
-                add_advanced_shadow(student_icon, blur=6, distance=3, transparency=0.25)
-                
-                icon_frame = student_icon.text_frame
-                icon_frame.text = "👤"
-                icon_p = icon_frame.paragraphs[0]
-                icon_p.font.size = Pt(30)
-                icon_p.alignment = PP_ALIGN.CENTER
-                icon_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                
-                student_frame = student_card.text_frame
-                student_frame.word_wrap = True
-                student_frame.margin_left = Inches(1.4)
-                student_frame.margin_right = Inches(0.3)
-                student_frame.margin_top = Inches(0.2)
-                
-                student_label = student_frame.paragraphs[0]
-                student_label.text = "Bajarildi:"
-                student_label.font.size = Pt(13)
-                student_label.font.bold = True
-                student_label.font.color.rgb = template['text_secondary']
-                student_label.alignment = PP_ALIGN.LEFT
-                
-                student_name_p = student_frame.add_paragraph()
-                student_name_p.text = slide_data.get('student', '')
-                student_name_p.font.size = Pt(20)
-                student_name_p.font.bold = True
-                student_name_p.font.color.rgb = template['text_primary']  # Dark text on white card
-                student_name_p.alignment = PP_ALIGN.LEFT
-                student_name_p.space_before = Pt(4)
-                
-                teacher_card = slide_obj.shapes.add_shape(
-                    MSO_SHAPE.ROUNDED_RECTANGLE,
-                    Inches(5.0), Inches(4.5), Inches(4.2), Inches(1.5)
-                )
-                teacher_card.fill.solid()
-                teacher_card.fill.fore_color.rgb = RGBColor(255, 255, 255)
-                teacher_card.line.color.rgb = template['accent']
-                teacher_card.line.width = Pt(5)
-                add_advanced_shadow(teacher_card, blur=10, distance=5, transparency=0.2)
-                
-                teacher_icon = slide_obj.shapes.add_shape(
-                    MSO_SHAPE.OVAL,
-                    Inches(7.9), Inches(4.8), Inches(0.9), Inches(0.9)
-                )
-                teacher_icon.fill.solid()
-                teacher_icon.fill.fore_color.rgb = template['accent']
-                teacher_icon.line.fill.background()
-                add_advanced_shadow(teacher_icon, blur=6, distance=3, transparency=0.25)
-                
-                teacher_icon_frame = teacher_icon.text_frame
-                teacher_icon_frame.text = "✔"
-                teacher_icon_p = teacher_icon_frame.paragraphs[0]
-                teacher_icon_p.font.size = Pt(40)
-                teacher_icon_p.font.bold = True
-                teacher_icon_p.font.color.rgb = RGBColor(255, 255, 255)  # White checkmark on colored circle
-                teacher_icon_p.alignment = PP_ALIGN.CENTER
-                teacher_icon_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                
-                teacher_frame = teacher_card.text_frame
-                teacher_frame.word_wrap = True
-                teacher_frame.margin_left = Inches(0.3)
-                teacher_frame.margin_right = Inches(1.4)
-                teacher_frame.margin_top = Inches(0.2)
-                
-                teacher_label = teacher_frame.paragraphs[0]
-                teacher_label.text = "Tekshirdi:"
-                teacher_label.font.size = Pt(13)
-                teacher_label.font.bold = True
-                teacher_label.font.color.rgb = template['text_secondary']
-                teacher_label.alignment = PP_ALIGN.RIGHT
-                
-                teacher_name_p = teacher_frame.add_paragraph()
-                teacher_name_p.text = slide_data.get('from_to', '')
-                teacher_name_p.font.size = Pt(20)
-                teacher_name_p.font.bold = True
-                teacher_name_p.font.color.rgb = template['text_primary']  # Dark text on white card
-                teacher_name_p.alignment = PP_ALIGN.RIGHT
-                teacher_name_p.space_before = Pt(4)
-
-            elif slide_type == "introduction":
-                side_bar = slide_obj.shapes.add_shape(
-                    MSO_SHAPE.ROUNDED_RECTANGLE,
-                    Inches(0.1), Inches(1.5), Inches(0.12), Inches(4.5)
-                )
-                side_bar.fill.solid()
-                side_bar.fill.fore_color.rgb = template['accent']
-                side_bar.line.fill.background()
-                
-                title_box = slide_obj.shapes.add_shape(
-                    MSO_SHAPE.ROUNDED_RECTANGLE,
-                    Inches(1.5), Inches(0.6), Inches(7), Inches(1.1)
-                )
-                title_box.fill.solid()
-                title_box.fill.fore_color.rgb = template['primary']
-                title_box.line.fill.background()
-                add_advanced_shadow(title_box, blur=14, distance=7, transparency=0.25)
-                
-                title_frame = title_box.text_frame
-                title_frame.text = slide_data.get("title", "Kirish va Reja")
-                title_frame.margin_left = Inches(0.5)
-                title_frame.margin_right = Inches(0.5)
-                title_p = title_frame.paragraphs[0]
-                title_p.font.size = Pt(42)
-                title_p.font.bold = True
-                title_p.font.color.rgb = RGBColor(255, 255, 255)  # White text on dark primary color
-                title_p.alignment = PP_ALIGN.CENTER
-                title_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                
-                if slide_data.get("content"):
-                    intro_box = slide_obj.shapes.add_shape(
-                        MSO_SHAPE.ROUNDED_RECTANGLE,
-                        Inches(1.5), Inches(2), Inches(7), Inches(1.3)
-                    )
-                    intro_box.fill.solid()
-                    intro_box.fill.fore_color.rgb = template['shape_fill']
-                    intro_box.line.color.rgb = template['accent']
-                    intro_box.line.width = Pt(3)
-                    add_advanced_shadow(intro_box, blur=8, distance=4, transparency=0.15)
-                    
-                    intro_frame = intro_box.text_frame
-                    intro_frame.word_wrap = True
-                    intro_frame.margin_left = Inches(0.5)
-                    intro_frame.margin_right = Inches(0.5)
-                    intro_frame.margin_top = Inches(0.3)
-                    intro_frame.margin_bottom = Inches(0.3)
-                    intro_frame.text = slide_data.get("content", "")
-                    intro_p = intro_frame.paragraphs[0]
-                    intro_p.font.size = Pt(18)
-                    intro_p.font.color.rgb = template['shape_text']  # Proper contrast text
-                    intro_p.line_spacing = 1.5
-                    intro_p.alignment = PP_ALIGN.CENTER
-                    intro_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                
-                outline_items = slide_data.get("outline", [])
-                if len(outline_items) >= 4:
-                    positions = [
-                        (1.5, 3.6), (5.5, 3.6),
-                        (1.5, 5.2), (5.5, 5.2)
-                    ]
-                    for i, item in enumerate(outline_items[:4]):
-                        x, y = positions[i]
-                        item_box = slide_obj.shapes.add_shape(
-                            MSO_SHAPE.ROUNDED_RECTANGLE,
-                            Inches(x), Inches(y), Inches(3.5), Inches(1.3)
-                        )
-                        item_box.fill.solid()
-                        item_box.fill.fore_color.rgb = RGBColor(255, 255, 255)
-                        item_box.line.color.rgb = template['primary']
-                        item_box.line.width = Pt(4)
-                        add_advanced_shadow(item_box, blur=8, distance=4, transparency=0.18)
-                        
-                        badge = slide_obj.shapes.add_shape(
-                            MSO_SHAPE.OVAL,
-                            Inches(x + 0.2), Inches(y + 0.15), Inches(0.5), Inches(0.5)
-                        )
-                        badge.fill.solid()
-                        badge.fill.fore_color.rgb = template['accent']
-                        badge.line.fill.background()
-                        
-                        badge_frame = badge.text_frame
-                        badge_frame.text = str(i + 1)
-                        badge_p = badge_frame.paragraphs[0]
-                        badge_p.font.size = Pt(20)
-                        badge_p.font.bold = True
-                        badge_p.font.color.rgb = RGBColor(255, 255, 255)  # White number on colored badge
-                        badge_p.alignment = PP_ALIGN.CENTER
-                        badge_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                        
-                        item_frame = item_box.text_frame
-                        item_frame.word_wrap = True
-                        item_frame.margin_left = Inches(0.85)
-                        item_frame.margin_right = Inches(0.3)
-                        item_frame.margin_top = Inches(0.25)
-                        item_frame.text = item
-                        item_p = item_frame.paragraphs[0]
-                        item_p.font.size = Pt(16)
-                        item_p.font.color.rgb = template['text_primary']  # Dark text on white box
-                        item_p.line_spacing = 1.3
-                        item_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-
-            elif slide_type == "content":
+# Slide layouts as data. Each spec has static "shapes" and item "groups"; a group repeats its
+# shapes for items of a slide field ("points", "outline", "takeaways"), placed at origin + i * step
+# (or at explicit offsets), with shape boxes relative to that position. All sizes are in inches.
+#
+# Colours name template roles ("primary", "accent", ...) or "white"; "line": None hides the outline.
+# Paragraph text is a literal string, {"field": name, "default": ...}, "$item", "$number" or {"each": [...]}.
+
+TEMPLATE_COLOR_ROLES = {
+    "bg_color", "primary", "accent", "text_primary", "text_secondary",
+    "shape_fill", "shape_text", "shape_border", "gradient_start", "gradient_end",
+}
+
+CONTENT_TITLE_SHAPE = {
+    "shape": "ROUNDED_RECTANGLE", "box": (0.6, 0.5, 8.8, 0.95),
+    "fill": "white", "line": "primary", "line_width": 6, "shadow": (12, 6, 0.2),
+    "frame": {"word_wrap": True, "margins": {"left": 0.4, "right": 0.4}, "anchor": "MIDDLE"},
+    "paragraphs": [{"text": {"field": "title", "default": ""}, "size": 38, "bold": True, "color": "primary", "align": "CENTER"}],
+}
+
+COMPARISON_BOX_SHAPE = {
+    "shape": "ROUNDED_RECTANGLE", "box": (0, 0, 4, 2.1),
+    "fill": "white", "line": "primary", "line_width": 4, "shadow": (8, 4, 0.18),
+    "frame": {"word_wrap": True, "margins": {"left": 0.3, "right": 0.3, "top": 0.75, "bottom": 0.3}, "anchor": "TOP"},
+    "paragraphs": [{"text": "$item", "size": 16, "color": "text_primary", "line_spacing": 1.3, "align": "CENTER"}],
+}
+
+TWO_COLUMN_SHAPES = [
+    {
+        "shape": "ROUNDED_RECTANGLE", "box": (0, 0, 4.3, 2.1),
+        "fill": "white", "line": "primary", "line_width": 5, "shadow": (10, 5, 0.2),
+        "frame": {"word_wrap": True, "margins": {"left": 0.3, "right": 0.3, "top": 0.85, "bottom": 0.3}, "anchor": "TOP"},
+        "paragraphs": [{"text": "$item", "size": 17, "color": "text_primary", "line_spacing": 1.3, "align": "CENTER"}],
+    },
+    {
+        "shape": "ROUNDED_RECTANGLE", "box": (0.3, 0.2, 0.6, 0.6), "fill": "accent", "line": None,
+        "frame": {"anchor": "MIDDLE"},
+        "paragraphs": [{"text": "$number", "size": 26, "bold": True, "color": "white", "align": "CENTER"}],
+    },
+]
+
+LAYOUT_SPECS = {
+    "title": {
+        "shapes": [
+            {
+                "shape": "ROUNDED_RECTANGLE", "box": (0.5, 0.6, 9, 1.1),
+                "fill": "white", "line": "primary", "line_width": 8, "shadow": (15, 8, 0.25),
+                "frame": {"word_wrap": True, "margins": {"left": 0.3, "right": 0.3, "top": 0.15, "bottom": 0.15}, "anchor": "MIDDLE"},
+                "paragraphs": [{"text": {"field": "title", "default": ""}, "size": 42, "bold": True, "color": "primary", "align": "CENTER", "line_spacing": 1.1}],
+            },
+            {
+                "shape": "ROUNDED_RECTANGLE", "box": (1, 2.1, 8, 1.8),
+                "fill": "shape_fill", "line": "accent", "line_width": 5, "shadow": (12, 6, 0.2),
+                "frame": {"word_wrap": True, "margins": {"left": 0.4, "right": 0.4, "top": 0.25, "bottom": 0.25}, "anchor": "MIDDLE"},
+                "paragraphs": [{"text": {"field": "university", "default": ""}, "size": 20, "bold": True, "color": "shape_text", "align": "CENTER", "line_spacing": 1.2}],
+            },
+            {
+                "shape": "ROUNDED_RECTANGLE", "box": (0.8, 4.5, 4.2, 1.5),
+                "fill": "white", "line": "accent", "line_width": 5, "shadow": (10, 5, 0.2),
+                "frame": {"word_wrap": True, "margins": {"left": 1.4, "right": 0.3, "top": 0.2}},
+                "paragraphs": [
+                    {"text": "Bajarildi:", "size": 13, "bold": True, "color": "text_secondary", "align": "LEFT"},
+                    {"text": {"field": "student", "default": ""}, "size": 20, "bold": True, "color": "text_primary", "align": "LEFT", "space_before": 4},
+                ],
+            },
+            {
+                "shape": "OVAL", "box": (1.2, 4.8, 0.9, 0.9), "fill": "primary", "line": None, "shadow": (6, 3, 0.25),
+                "frame": {"anchor": "MIDDLE"},
+                "paragraphs": [{"text": "👤", "size": 30, "align": "CENTER"}],
+            },
+            {
+                "shape": "ROUNDED_RECTANGLE", "box": (5.0, 4.5, 4.2, 1.5),
+                "fill": "white", "line": "accent", "line_width": 5, "shadow": (10, 5, 0.2),
+                "frame": {"word_wrap": True, "margins": {"left": 0.3, "right": 1.4, "top": 0.2}},
+                "paragraphs": [
+                    {"text": "Tekshirdi:", "size": 13, "bold": True, "color": "text_secondary", "align": "RIGHT"},
+                    {"text": {"field": "from_to", "default": ""}, "size": 20, "bold": True, "color": "text_primary", "align": "RIGHT", "space_before": 4},
+                ],
+            },
+            {
+                "shape": "OVAL", "box": (7.9, 4.8, 0.9, 0.9), "fill": "accent", "line": None, "shadow": (6, 3, 0.25),
+                "frame": {"anchor": "MIDDLE"},
+                "paragraphs": [{"text": "✔", "size": 40, "bold": True, "color": "white", "align": "CENTER"}],
+            },
+        ],
+    },
+    "introduction": {
+        "shapes": [
+            {"shape": "ROUNDED_RECTANGLE", "box": (0.1, 1.5, 0.12, 4.5), "fill": "accent", "line": None},
+            {
+                "shape": "ROUNDED_RECTANGLE", "box": (1.5, 0.6, 7, 1.1), "fill": "primary", "line": None, "shadow": (14, 7, 0.25),
+                "frame": {"margins": {"left": 0.5, "right": 0.5}, "anchor": "MIDDLE"},
+                "paragraphs": [{"text": {"field": "title", "default": "Kirish va Reja"}, "size": 42, "bold": True, "color": "white", "align": "CENTER"}],
+            },
+            {
+                "when": "content",
+                "shape": "ROUNDED_RECTANGLE", "box": (1.5, 2, 7, 1.3),
+                "fill": "shape_fill", "line": "accent", "line_width": 3, "shadow": (8, 4, 0.15),
+                "frame": {"word_wrap": True, "margins": {"left": 0.5, "right": 0.5, "top": 0.3, "bottom": 0.3}, "anchor": "MIDDLE"},
+                "paragraphs": [{"text": {"field": "content", "default": ""}, "size": 18, "color": "shape_text", "line_spacing": 1.5, "align": "CENTER"}],
+            },
+        ],
+        "groups": [
+            {
+                "source": "outline", "count": 4, "min": SLIDE_LIST_MIN["outline"],
+                "offsets": [(1.5, 3.6), (5.5, 3.6), (1.5, 5.2), (5.5, 5.2)],
+                "shapes": [
+                    {
+                        "shape": "ROUNDED_RECTANGLE", "box": (0, 0, 3.5, 1.3),
+                        "fill": "white", "line": "primary", "line_width": 4, "shadow": (8, 4, 0.18),
+                        "frame": {"word_wrap": True, "margins": {"left": 0.85, "right": 0.3, "top": 0.25}, "anchor": "MIDDLE"},
+                        "paragraphs": [{"text": "$item", "size": 16, "color": "text_primary", "line_spacing": 1.3}],
+                    },
+                    {
+                        "shape": "OVAL", "box": (0.2, 0.15, 0.5, 0.5), "fill": "accent", "line": None,
+                        "frame": {"anchor": "MIDDLE"},
+                        "paragraphs": [{"text": "$number", "size": 20, "bold": True, "color": "white", "align": "CENTER"}],
+                    },
+                ],
+            },
+        ],
+    },
+    "conclusion": {
+        "shapes": [
+            {"shape": "ROUNDED_RECTANGLE", "box": (3, 0.4, 4, 0.3), "fill": "accent", "line": None},
+            {
+                "shape": "ROUNDED_RECTANGLE", "box": (2, 0.8, 6, 1), "fill": "primary", "line": None, "shadow": (14, 7, 0.25),
+                "frame": {"margins": {"left": 0.5, "right": 0.5}, "anchor": "MIDDLE"},
+                "paragraphs": [{"text": {"field": "title", "default": "Xulosa"}, "size": 42, "bold": True, "color": "white", "align": "CENTER"}],
+            },
+            {
+                "when": "summary",
+                "shape": "ROUNDED_RECTANGLE", "box": (1.5, 2.1, 7, 1.4),
+                "fill": "shape_fill", "line": "accent", "line_width": 4, "shadow": (10, 5, 0.18),
+                "frame": {"word_wrap": True, "margins": {"left": 0.5, "right": 0.5, "top": 0.3, "bottom": 0.3}, "anchor": "MIDDLE"},
+                "paragraphs": [{"text": {"field": "summary", "default": ""}, "size": 18, "color": "shape_text", "line_spacing": 1.5, "align": "CENTER"}],
+            },
+        ],
+        "groups": [
+            {
+                "source": "takeaways", "count": 3, "min": SLIDE_LIST_MIN["takeaways"], "origin": (0.8, 0), "step": (3, 0),
+                "shapes": [
+                    {
+                        "shape": "ROUNDED_RECTANGLE", "box": (0, 3.9, 2.8, 2.3),
+                        "fill": "white", "line": "primary", "line_width": 5, "shadow": (10, 5, 0.2),
+                        "frame": {"word_wrap": True, "margins": {"left": 0.25, "right": 0.25, "top": 0.85, "bottom": 0.25}, "anchor": "TOP"},
+                        "paragraphs": [{"text": "$item", "size": 15, "color": "text_primary", "line_spacing": 1.3, "align": "CENTER"}],
+                    },
+                    {
+                        "shape": "OVAL", "box": (1.15, 4.2, 0.5, 0.5), "fill": "accent", "line": None,
+                        "frame": {"anchor": "MIDDLE"},
+                        "paragraphs": [{"text": "✓", "size": 24, "bold": True, "color": "white", "align": "CENTER"}],
+                    },
+                ],
+            },
+        ],
+    },
+    "cards": {
+        "shapes": [CONTENT_TITLE_SHAPE],
+        "groups": [
+            {
+                "source": "points", "count": 4, "origin": (0, 1.8), "step": (0, 1.35),
+                "shapes": [
+                    {
+                        "shape": "ROUNDED_RECTANGLE", "box": (0.8, 0, 8.4, 1.2),
+                        "fill": "shape_fill", "line": "accent", "line_width": 4, "shadow": (8, 4, 0.18),
+                        "frame": {"word_wrap": True, "margins": {"left": 0.95, "right": 0.4, "top": 0.25, "bottom": 0.25}, "anchor": "MIDDLE"},
+                        "paragraphs": [{"text": "$item", "size": 19, "color": "shape_text", "line_spacing": 1.4}],
+                    },
+                    {"shape": "OVAL", "box": (1.2, 0.45, 0.3, 0.3), "fill": "accent", "line": None},
+                    {"shape": "RECTANGLE", "box": (1.65, 0.35, 0.04, 0.5), "fill": "primary", "line": None},
+                ],
+            },
+        ],
+    },
+    "two_column": {
+        "shapes": [CONTENT_TITLE_SHAPE],
+        "groups": [
+            {"source": "points", "count": 2, "origin": (0.6, 1.9), "step": (0, 2.4), "shapes": TWO_COLUMN_SHAPES},
+            {"source": "points", "start": 2, "count": 2, "origin": (5.1, 1.9), "step": (0, 2.4), "shapes": TWO_COLUMN_SHAPES},
+        ],
+    },
+    "timeline": {
+        "shapes": [CONTENT_TITLE_SHAPE],
+        "groups": [
+            {
+                "source": "points", "count": 4, "origin": (0.8, 0), "step": (2.2, 0),
+                "shapes": [
+                    {
+                        "shape": "ROUNDED_RECTANGLE", "box": (0, 2.5, 2, 3.5),
+                        "fill": "white", "line": "accent", "line_width": 5, "shadow": (10, 5, 0.2),
+                        "frame": {"word_wrap": True, "margins": {"left": 0.2, "right": 0.2, "top": 0.9}, "anchor": "TOP"},
+                        "paragraphs": [{"text": "$item", "size": 15, "color": "text_primary", "line_spacing": 1.3, "align": "CENTER"}],
+                    },
+                    {
+                        "shape": "OVAL", "box": (0.75, 2.8, 0.5, 0.5), "fill": "primary", "line": None,
+                        "frame": {"anchor": "MIDDLE"},
+                        "paragraphs": [{"text": "$number", "size": 22, "bold": True, "color": "white", "align": "CENTER"}],
+                    },
+                    {"shape": "RIGHT_ARROW", "box": (2.05, 4.2, 0.15, 0.3), "fill": "accent", "line": None, "skip_last": True},
+                ],
+            },
+        ],
+    },
+    "comparison": {
+        "shapes": [
+            CONTENT_TITLE_SHAPE,
+            {"shape": "ROUNDED_RECTANGLE", "box": (4.85, 1.7, 0.3, 5), "fill": "accent", "line": None},
+        ],
+        "groups": [
+            {
+                "source": "points", "count": 2, "origin": (0.6, 1.9), "step": (0, 2.4),
+                "shapes": [
+                    COMPARISON_BOX_SHAPE,
+                    {
+                        "shape": "ROUNDED_RECTANGLE", "box": (0.3, 0.2, 0.5, 0.5), "fill": "accent", "line": None,
+                        "frame": {"anchor": "MIDDLE"},
+                        "paragraphs": [{"text": "◆", "size": 20, "color": "white", "align": "CENTER"}],
+                    },
+                ],
+            },
+            {
+                "source": "points", "start": 2, "count": 2, "origin": (5.4, 1.9), "step": (0, 2.4),
+                "shapes": [
+                    COMPARISON_BOX_SHAPE,
+                    {
+                        "shape": "ROUNDED_RECTANGLE", "box": (3.1, 0.2, 0.5, 0.5), "fill": "accent", "line": None,
+                        "frame": {"anchor": "MIDDLE"},
+                        "paragraphs": [{"text": "◆", "size": 20, "color": "white", "align": "CENTER"}],
+                    },
+                ],
+            },
+        ],
+    },
+    "grid": {
+        "shapes": [CONTENT_TITLE_SHAPE],
+        "groups": [
+            {
+                "source": "points", "count": 4,
+                "offsets": [(0.6, 1.8), (5.2, 1.8), (0.6, 4.5), (5.2, 4.5)],
+                "shapes": [
+                    {
+                        "shape": "ROUNDED_RECTANGLE", "box": (0, 0, 4.2, 2.4),
+                        "fill": "white", "line": "accent", "line_width": 5, "shadow": (10, 5, 0.2),
+                        "frame": {"word_wrap": True, "margins": {"left": 0.4, "right": 0.4, "top": 1.1}, "anchor": "TOP"},
+                        "paragraphs": [{"text": "$item", "size": 17, "color": "text_primary", "line_spacing": 1.3, "align": "CENTER"}],
+                    },
+                    {
+                        "shape": "OVAL", "box": (0.3, 0.3, 0.6, 0.6), "fill": "primary", "line": None,
+                        "frame": {"anchor": "MIDDLE"},
+                        "paragraphs": [{"text": "$number", "size": 24, "bold": True, "color": "white", "align": "CENTER"}],
+                    },
+                ],
+            },
+        ],
+    },
+    "numbered": {
+        "shapes": [CONTENT_TITLE_SHAPE],
+        "groups": [
+            {
+                "source": "points", "count": 4, "origin": (0, 1.8), "step": (0, 1.35),
+                "shapes": [
+                    {
+                        "shape": "ROUNDED_RECTANGLE", "box": (0.8, 0, 1, 1.2), "fill": "primary", "line": None, "shadow": (8, 4, 0.2),
+                        "frame": {"anchor": "MIDDLE"},
+                        "paragraphs": [{"text": "$number", "size": 48, "bold": True, "color": "white", "align": "CENTER"}],
+                    },
+                    {
+                        "shape": "ROUNDED_RECTANGLE", "box": (2, 0, 7.2, 1.2),
+                        "fill": "shape_fill", "line": "accent", "line_width": 4, "shadow": (8, 4, 0.18),
+                        "frame": {"word_wrap": True, "margins": {"left": 0.4, "right": 0.4, "top": 0.25}, "anchor": "MIDDLE"},
+                        "paragraphs": [{"text": "$item", "size": 19, "color": "shape_text", "line_spacing": 1.4}],
+                    },
+                ],
+            },
+        ],
+    },
+    "highlight": {
+        "shapes": [CONTENT_TITLE_SHAPE],
+        "groups": [
+            {
+                "source": "points", "count": 4, "origin": (0, 1.8), "step": (0, 1.35),
+                "shapes": [
+                    {
+                        "shape": "ROUNDED_RECTANGLE", "box": (1.2, 0, 7.6, 1.2),
+                        "fill": "white", "line": "primary", "line_width": 5, "shadow": (10, 5, 0.2),
+                        "frame": {"word_wrap": True, "margins": {"left": 0.6, "right": 0.4, "top": 0.25}, "anchor": "MIDDLE"},
+                        "paragraphs": [{"text": "$item", "size": 19, "color": "text_primary", "line_spacing": 1.4}],
+                    },
+                    {"shape": "ROUNDED_RECTANGLE", "box": (1.3, 0.2, 0.15, 0.8), "fill": "accent", "line": None},
+                ],
+            },
+        ],
+    },
+    "icon_based": {
+        "shapes": [CONTENT_TITLE_SHAPE],
+        "groups": [
+            {
+                "source": "points", "count": 4, "origin": (0, 1.8), "step": (0, 1.35),
+                "shapes": [
+                    {
+                        "shape": "OVAL", "box": (0.9, 0.2, 0.8, 0.8), "fill": "accent", "line": None, "shadow": (6, 3, 0.2),
+                        "frame": {"anchor": "MIDDLE"},
+                        "paragraphs": [{"text": {"each": ["★", "●", "■", "▲"]}, "size": 32, "bold": True, "color": "white", "align": "CENTER"}],
+                    },
+                    {
+                        "shape": "ROUNDED_RECTANGLE", "box": (1.9, 0, 7.3, 1.2),
+                        "fill": "white", "line": "primary", "line_width": 4, "shadow": (8, 4, 0.18),
+                        "frame": {"word_wrap": True, "margins": {"left": 0.4, "right": 0.4, "top": 0.25}, "anchor": "MIDDLE"},
+                        "paragraphs": [{"text": "$item", "size": 19, "color": "text_primary", "line_spacing": 1.4}],
+                    },
+                ],
+            },
+        ],
+    },
+}
+
+SHAPE_SPEC_KEYS = {"shape", "box", "fill", "line", "line_width", "shadow", "frame", "paragraphs", "when", "skip_last"}
+GROUP_SPEC_KEYS = {"source", "start", "count", "min", "origin", "step", "offsets", "shapes"}
+PARAGRAPH_SPEC_KEYS = {"text", "size", "bold", "color", "align", "line_spacing", "space_before"}
+FRAME_MARGINS = ("left", "right", "top", "bottom")
+
+def to_emu(inches):
+    return Emu(round(inches * 914400))
+
+def compile_text_spec(text, where):
+    if isinstance(text, str):
+        if text in ("$item", "$number"):
+            return (text[1:],)
+        return ("literal", text)
+    if isinstance(text, dict) and set(text) == {"field", "default"}:
+        return ("field", text["field"], text["default"])
+    if isinstance(text, dict) and set(text) == {"each"}:
+        return ("each", tuple(text["each"]))
+    raise ValueError(f"{where}: bad text spec {text!r}")
+
+def compile_color(role, where):
+    if role is None or role == "white":
+        return role
+    if role not in TEMPLATE_COLOR_ROLES:
+        raise ValueError(f"{where}: unknown colour role {role!r}")
+    return role
+
+def compile_shape_spec(spec, where, positions=((0, 0),)):
+    """Resolve one shape spec into enums and EMU boxes, one box per item position"""
+    unknown = set(spec) - SHAPE_SPEC_KEYS
+    if unknown:
+        raise ValueError(f"{where}: unknown keys {sorted(unknown)}")
+    x, y, width, height = spec["box"]
+    boxes = []
+    for dx, dy in positions:
+        left, top = dx + x, dy + y
+        if left < 0 or top < 0 or left + width > 10.01 or top + height > 7.51:
+            raise ValueError(f"{where}: box {(left, top, width, height)} falls outside the 10x7.5in slide")
+        boxes.append((to_emu(left), to_emu(top), to_emu(width), to_emu(height)))
+
+    frame = dict(spec.get("frame", {}))
+    margins = frame.pop("margins", {})
+    anchor = frame.pop("anchor", None)
+    word_wrap = frame.pop("word_wrap", None)
+    if frame or set(margins) - set(FRAME_MARGINS):
+        raise ValueError(f"{where}: unknown frame keys {sorted(set(frame) | (set(margins) - set(FRAME_MARGINS)))}")
+
+    paragraphs = []
+    for p_spec in spec.get("paragraphs", []):
+        if set(p_spec) - PARAGRAPH_SPEC_KEYS:
+            raise ValueError(f"{where}: unknown paragraph keys {sorted(set(p_spec) - PARAGRAPH_SPEC_KEYS)}")
+        paragraphs.append({
+            "text": compile_text_spec(p_spec["text"], where),
+            "size": Pt(p_spec["size"]) if "size" in p_spec else None,
+            "bold": p_spec.get("bold"),
+            "color": compile_color(p_spec.get("color"), where),
+            "align": getattr(PP_ALIGN, p_spec["align"]) if "align" in p_spec else None,
+            "line_spacing": p_spec.get("line_spacing"),
+            "space_before": Pt(p_spec["space_before"]) if "space_before" in p_spec else None,
+        })
+
+    return {
+        "shape": getattr(MSO_SHAPE, spec["shape"]),
+        "boxes": tuple(boxes),
+        "fill": compile_color(spec["fill"], where),
+        "line": compile_color(spec.get("line"), where),
+        "line_width": Pt(spec["line_width"]) if "line_width" in spec else None,
+        "shadow": spec.get("shadow"),
+        "word_wrap": word_wrap,
+        "margins": tuple((f"margin_{side}", to_emu(margins[side])) for side in FRAME_MARGINS if side in margins),
+        "anchor": getattr(MSO_ANCHOR, anchor) if anchor else None,
+        "paragraphs": tuple(paragraphs),
+        "when": spec.get("when"),
+        "skip_last": spec.get("skip_last", False),
+    }
+
+def compile_layout_spec(name, spec):
+    """Validate a layout spec and turn it into a render plan with every box precomputed"""
+    if set(spec) - {"shapes", "groups"}:
+        raise ValueError(f"{name}: unknown keys {sorted(set(spec) - {'shapes', 'groups'})}")
+    plan = {
+        "shapes": tuple(compile_shape_spec(s, f"{name}.shapes[{i}]") for i, s in enumerate(spec.get("shapes", []))),
+        "groups": [],
+    }
+    for g, group in enumerate(spec.get("groups", [])):
+        where = f"{name}.groups[{g}]"
+        if set(group) - GROUP_SPEC_KEYS:
+            raise ValueError(f"{where}: unknown keys {sorted(set(group) - GROUP_SPEC_KEYS)}")
+        count = group["count"]
+        if "offsets" in group:
+            positions = tuple(group["offsets"])
+            if len(positions) != count:
+                raise ValueError(f"{where}: {count} items but {len(positions)} offsets")
+        else:
+            (x, y), (dx, dy) = group["origin"], group["step"]
+            positions = tuple((x + i * dx, y + i * dy) for i in range(count))
+        plan["groups"].append({
+            "source": group["source"],
+            "start": group.get("start", 0),
+            "count": count,
+            "min": group.get("min", 0),
+            "shapes": tuple(compile_shape_spec(s, f"{where}.shapes[{i}]", positions) for i, s in enumerate(group["shapes"])),
+        })
+    plan["groups"] = tuple(plan["groups"])
+    return plan
+
+def resolve_color(template, role):
+    return RGBColor(255, 255, 255) if role == "white" else template[role]
+
+def draw_plan_shape(shapes, template, shape_plan, slide_data, item_index=0, item=None, number=None):
+    left, top, width, height = shape_plan["boxes"][item_index]
+    shape = shapes.add_shape(shape_plan["shape"], left, top, width, height)
+    shape.fill.solid()
+    shape.fill.fore_color.rgb = resolve_color(template, shape_plan["fill"])
+    if shape_plan["line"] is None:
+        shape.line.fill.background()
+    else:
+        shape.line.color.rgb = resolve_color(template, shape_plan["line"])
+        if shape_plan["line_width"] is not None:
+            shape.line.width = shape_plan["line_width"]
+    if shape_plan["shadow"]:
+        blur, distance, transparency = shape_plan["shadow"]
+        add_advanced_shadow(shape, blur=blur, distance=distance, transparency=transparency)
+
+    if not shape_plan["paragraphs"]:
+        return shape
+
+    frame = shape.text_frame
+    if shape_plan["word_wrap"] is not None:
+        frame.word_wrap = shape_plan["word_wrap"]
+    for attr, value in shape_plan["margins"]:
+        setattr(frame, attr, value)
+
+    for p_index, p_plan in enumerate(shape_plan["paragraphs"]):
+        kind = p_plan["text"][0]
+        if kind == "literal":
+            text = p_plan["text"][1]
+        elif kind == "field":
+            text = slide_data.get(p_plan["text"][1], p_plan["text"][2])
+        elif kind == "item":
+            text = item
+        elif kind == "number":
+            text = str(number)
+        else:
+            text = p_plan["text"][1][item_index]
+
+        # A lone paragraph replaces the frame text; extra paragraphs are appended after the first
+        if len(shape_plan["paragraphs"]) == 1:
+            frame.text = text
+            paragraph = frame.paragraphs[0]
+        elif p_index == 0:
+            paragraph = frame.paragraphs[0]
+            paragraph.text = text
+        else:
+            paragraph = frame.add_paragraph()
+            paragraph.text = text
+
+        if p_plan["size"] is not None:
+            paragraph.font.size = p_plan["size"]
+        if p_plan["bold"] is not None:
+            paragraph.font.bold = p_plan["bold"]
+        if p_plan["color"] is not None:
+            paragraph.font.color.rgb = resolve_color(template, p_plan["color"])
+        if p_plan["align"] is not None:
+            paragraph.alignment = p_plan["align"]
+        if p_plan["line_spacing"] is not None:
+            paragraph.line_spacing = p_plan["line_spacing"]
+        if p_plan["space_before"] is not None:
+            paragraph.space_before = p_plan["space_before"]
+
+    if shape_plan["anchor"] is not None:
+        frame.vertical_anchor = shape_plan["anchor"]
+    return shape
+
+def apply_layout_plan(slide_obj, template, plan, slide_data):
+    """Draw a compiled layout plan onto slide_obj, filling text from slide_data"""
+    shapes = slide_obj.shapes
+    for shape_plan in plan["shapes"]:
+        if shape_plan["when"] and not slide_data.get(shape_plan["when"]):
+            continue
+        draw_plan_shape(shapes, template, shape_plan, slide_data)
+
+    for group in plan["groups"]:
+        items = slide_data.get(group["source"]) or []
+        if len(items) < group["min"]:
+            continue
+        start = group["start"]
+        for i, item in enumerate(items[start:start + group["count"]]):
+            for shape_plan in group["shapes"]:
+                if shape_plan["skip_last"] and i == group["count"] - 1:
+                    continue
+                draw_plan_shape(shapes, template, shape_plan, slide_data, i, item, start + i + 1)
+
+LAYOUT_PLANS = {name: compile_layout_spec(name, spec) for name, spec in LAYOUT_SPECS.items()}
+
+def draw_content_slide(slide_obj, template, title, points, layout_choice):
+    """Draw a content slide's title box and its four points in the given layout"""
+    apply_layout_plan(slide_obj, template, LAYOUT_PLANS[layout_choice], {"title": title, "points": points})
+
+
+def get_slide_prototype(template, layout_choice):
+    """Draw a content slide once per (template, layout) with marker text and keep its shape XML"""
+    key = (template['name'], layout_choice)
+    prototype = slide_prototype_cache.get(key)
+    if prototype is None:
+        prs = new_presentation(template)
+        slide_obj = prs.slides.add_slide(prs.slide_layouts[6])
+        draw_content_slide(slide_obj, template, "{{title}}", [f"{{{{point{i}}}}}" for i in range(4)], layout_choice)
+        frame_tags = (qn('p:nvGrpSpPr'), qn('p:grpSpPr'))
+        prototype = [el for el in slide_obj.shapes._spTree.iterchildren() if el.tag not in frame_tags]
+        slide_prototype_cache[key] = prototype
+    return prototype
+
+def clone_content_slide(slide_obj, template, title, points, layout_choice):
+    """Copy the cached prototype shapes onto slide_obj and swap the marker text for real text"""
+    texts = {"{{title}}": title}
+    for i, point in enumerate(points[:4]):
+        texts[f"{{{{point{i}}}}}"] = point
+    
+    sp_tree = slide_obj.shapes._spTree
+    for element in get_slide_prototype(template, layout_choice):
+        element = copy.deepcopy(element)
+        for text_el in element.iter(qn('a:t')):
+            if text_el.text in texts:
+                text_el.text = XML_INVALID_CHARS.sub(lambda m: f"_x{ord(m.group()):04X}_", str(texts[text_el.text]))
+        sp_tree.append(element)
+
+
+def render_slide(prs, template, idx, slide_data, used_layouts, image=None, rng=random):
+    """Append one slide to prs; used_layouts tracks recent content layouts so they don't repeat"""
+    print(f"[v0] Creating readable slide {idx + 1}")
+    slide_type = slide_data.get("type", "content")
+    
+    # Background, top accent bar and corner circle come from the template's Blank layout
+    slide_layout = prs.slide_layouts[6]
+    slide_obj = prs.slides.add_slide(slide_layout)
+
+    try:
+        with stage_metrics.track("render_slide"):
+            if slide_type == "content":
                 points = slide_data.get("points", [])
-                
+            
                 while len(points) < 4:
                     points.append(f"Qo'shimcha ma'lumot {len(points) + 1}")
-                
-                available_layouts = [l for l in layout_types if l not in used_layouts[-3:]]
+            
+                available_layouts = [l for l in LAYOUT_TYPES if l not in used_layouts[-3:]]
                 if not available_layouts:
-                    available_layouts = layout_types
-                
-                layout_choice = random.choice(available_layouts)
+                    available_layouts = LAYOUT_TYPES
+            
+                layout_choice = rng.choice(available_layouts)
                 used_layouts.append(layout_choice)
-                
-                title_box = slide_obj.shapes.add_shape(
-                    MSO_SHAPE.ROUNDED_RECTANGLE,
-                    Inches(0.6), Inches(0.5), Inches(8.8), Inches(0.95)
-                )
-                title_box.fill.solid()
-                title_box.fill.fore_color.rgb = RGBColor(255, 255, 255)
-                title_box.line.color.rgb = template['primary']
-                title_box.line.width = Pt(6)
-                add_advanced_shadow(title_box, blur=12, distance=6, transparency=0.2)
-                
-                title_frame = title_box.text_frame
-                title_frame.word_wrap = True
-                title_frame.margin_left = Inches(0.4)
-                title_frame.margin_right = Inches(0.4)
-                title_frame.text = slide_data.get("title", "")
-                title_p = title_frame.paragraphs[0]
-                title_p.font.size = Pt(38)
-                title_p.font.bold = True
-                title_p.font.color.rgb = template['primary']
-                title_p.alignment = PP_ALIGN.CENTER
-                title_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                
-                if layout_choice == "cards":
-                    start_y = 1.8
-                    spacing = 1.35
-                    
-                    for i, point in enumerate(points[:4]):
-                        point_box = slide_obj.shapes.add_shape(
-                            MSO_SHAPE.ROUNDED_RECTANGLE,
-                            Inches(0.8), Inches(start_y + i * spacing), Inches(8.4), Inches(1.2)
-                        )
-                        point_box.fill.solid()
-                        point_box.fill.fore_color.rgb = template['shape_fill']
-                        point_box.line.color.rgb = template['accent']
-                        point_box.line.width = Pt(4)
-                        add_advanced_shadow(point_box, blur=8, distance=4, transparency=0.18)
-                        
-                        bullet_circle = slide_obj.shapes.add_shape(
-                            MSO_SHAPE.OVAL,
-                            Inches(1.2), Inches(start_y + i * spacing + 0.45), Inches(0.3), Inches(0.3)
-                        )
-                        bullet_circle.fill.solid()
-                        bullet_circle.fill.fore_color.rgb = template['accent']
-                        bullet_circle.line.fill.background()
-                        
-                        separator = slide_obj.shapes.add_shape(
-                            MSO_SHAPE.RECTANGLE,
-                            Inches(1.65), Inches(start_y + i * spacing + 0.35), Inches(0.04), Inches(0.5)
-                        )
-                        separator.fill.solid()
-                        separator.fill.fore_color.rgb = template['primary']
-                        separator.line.fill.background()
-                        
-                        point_frame = point_box.text_frame
-                        point_frame.word_wrap = True
-                        point_frame.margin_left = Inches(0.95)
-                        point_frame.margin_right = Inches(0.4)
-                        point_frame.margin_top = Inches(0.25)
-                        point_frame.margin_bottom = Inches(0.25)
-                        point_frame.text = point
-                        point_p = point_frame.paragraphs[0]
-                        point_p.font.size = Pt(19)
-                        point_p.font.color.rgb = template['shape_text']  # Proper contrast text
-                        point_p.line_spacing = 1.4
-                        point_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                
-                elif layout_choice in ["two_column", "timeline", "comparison", "grid", "numbered", "highlight", "icon_based"]:
-                    # Using template['shape_text'] for text on shape_fill backgrounds
-                    # Using template['text_primary'] for text on white backgrounds
-                    # Using RGBColor(255, 255, 255) for text on dark/colored backgrounds
-                    
-                    # --- Two Column Layout ---
-                    if layout_choice == "two_column":
-                        left_points = points[:2]  # First 2 points
-                        right_points = points[2:4]  # Next 2 points
-                        
-                        for i, point in enumerate(left_points):
-                            point_box = slide_obj.shapes.add_shape(
-                                MSO_SHAPE.ROUNDED_RECTANGLE,
-                                Inches(0.6), Inches(1.9 + i * 2.4), Inches(4.3), Inches(2.1)
-                            )
-                            point_box.fill.solid()
-                            point_box.fill.fore_color.rgb = RGBColor(255, 255, 255)
-                            point_box.line.color.rgb = template['primary']
-                            point_box.line.width = Pt(5)
-                            add_advanced_shadow(point_box, blur=10, distance=5, transparency=0.2)
-                            
-                            number_box = slide_obj.shapes.add_shape(
-                                MSO_SHAPE.ROUNDED_RECTANGLE,
-                                Inches(0.9), Inches(2.1 + i * 2.4), Inches(0.6), Inches(0.6)
-                            )
-                            number_box.fill.solid()
-                            number_box.fill.fore_color.rgb = template['accent']
-                            number_box.line.fill.background()
-                            
-                            num_frame = number_box.text_frame
-                            num_frame.text = str(i + 1)
-                            num_p = num_frame.paragraphs[0]
-                            num_p.font.size = Pt(26)
-                            num_p.font.bold = True
-                            num_p.font.color.rgb = RGBColor(255, 255, 255)
-                            num_p.alignment = PP_ALIGN.CENTER
-                            num_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                            
-                            point_frame = point_box.text_frame
-                            point_frame.word_wrap = True
-                            point_frame.margin_left = Inches(0.3)
-                            point_frame.margin_right = Inches(0.3)
-                            point_frame.margin_top = Inches(0.85)
-                            point_frame.margin_bottom = Inches(0.3)
-                            point_frame.text = point
-                            point_p = point_frame.paragraphs[0]
-                            point_p.font.size = Pt(17)
-                            point_p.font.color.rgb = template['text_primary']  # Dark text on white
-                            point_p.line_spacing = 1.3
-                            point_p.alignment = PP_ALIGN.CENTER
-                            point_frame.vertical_anchor = MSO_ANCHOR.TOP
-                        
-                        for i, point in enumerate(right_points):
-                            point_box = slide_obj.shapes.add_shape(
-                                MSO_SHAPE.ROUNDED_RECTANGLE,
-                                Inches(5.1), Inches(1.9 + i * 2.4), Inches(4.3), Inches(2.1)
-                            )
-                            point_box.fill.solid()
-                            point_box.fill.fore_color.rgb = RGBColor(255, 255, 255)
-                            point_box.line.color.rgb = template['primary']
-                            point_box.line.width = Pt(5)
-                            add_advanced_shadow(point_box, blur=10, distance=5, transparency=0.2)
-                            
-                            number_box = slide_obj.shapes.add_shape(
-                                MSO_SHAPE.ROUNDED_RECTANGLE,
-                                Inches(5.4), Inches(2.1 + i * 2.4), Inches(0.6), Inches(0.6)
-                            )
-                            number_box.fill.solid()
-                            number_box.fill.fore_color.rgb = template['accent']
-                            number_box.line.fill.background()
-                            
-                            num_frame = number_box.text_frame
-                            num_frame.text = str(i + 3)
-                            num_p = num_frame.paragraphs[0]
-                            num_p.font.size = Pt(26)
-                            num_p.font.bold = True
-                            num_p.font.color.rgb = RGBColor(255, 255, 255)
-                            num_p.alignment = PP_ALIGN.CENTER
-                            num_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                            
-                            point_frame = point_box.text_frame
-                            point_frame.word_wrap = True
-                            point_frame.margin_left = Inches(0.3)
-                            point_frame.margin_right = Inches(0.3)
-                            point_frame.margin_top = Inches(0.85)
-                            point_frame.margin_bottom = Inches(0.3)
-                            point_frame.text = point
-                            point_p = point_frame.paragraphs[0]
-                            point_p.font.size = Pt(17)
-                            point_p.font.color.rgb = template['text_primary']  # Dark text on white
-                            point_p.line_spacing = 1.3
-                            point_p.alignment = PP_ALIGN.CENTER
-                            point_frame.vertical_anchor = MSO_ANCHOR.TOP
-                    
-                    # --- Timeline Layout ---
-                    elif layout_choice == "timeline":
-                        for i, point in enumerate(points[:4]):
-                            node_x = 0.8 + i * 2.2
-                            node_box = slide_obj.shapes.add_shape(
-                                MSO_SHAPE.ROUNDED_RECTANGLE,
-                                Inches(node_x), Inches(2.5), Inches(2), Inches(3.5)
-                            )
-                            node_box.fill.solid()
-                            node_box.fill.fore_color.rgb = RGBColor(255, 255, 255)
-                            node_box.line.color.rgb = template['accent']
-                            node_box.line.width = Pt(5)
-                            add_advanced_shadow(node_box, blur=10, distance=5, transparency=0.2)
-                            
-                            circle = slide_obj.shapes.add_shape(
-                                MSO_SHAPE.OVAL,
-                                Inches(node_x + 0.75), Inches(2.8), Inches(0.5), Inches(0.5)
-                            )
-                            circle.fill.solid()
-                            circle.fill.fore_color.rgb = template['primary']
-                            circle.line.fill.background()
-                            
-                            circle_frame = circle.text_frame
-                            circle_frame.text = str(i + 1)
-                            circle_p = circle_frame.paragraphs[0]
-                            circle_p.font.size = Pt(22)
-                            circle_p.font.bold = True
-                            circle_p.font.color.rgb = RGBColor(255, 255, 255)
-                            circle_p.alignment = PP_ALIGN.CENTER
-                            circle_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                            
-                            node_frame = node_box.text_frame
-                            node_frame.word_wrap = True
-                            node_frame.margin_left = Inches(0.2)
-                            node_frame.margin_right = Inches(0.2)
-                            node_frame.margin_top = Inches(0.9)
-                            node_frame.text = point
-                            node_p = node_frame.paragraphs[0]
-                            node_p.font.size = Pt(15)
-                            node_p.font.color.rgb = template['text_primary']
-                            node_p.line_spacing = 1.3
-                            node_p.alignment = PP_ALIGN.CENTER
-                            node_frame.vertical_anchor = MSO_ANCHOR.TOP
-                            
-                            if i < 3:
-                                arrow = slide_obj.shapes.add_shape(
-                                    MSO_SHAPE.RIGHT_ARROW,
-                                    Inches(node_x + 2.05), Inches(4.2), Inches(0.15), Inches(0.3)
-                                )
-                                arrow.fill.solid()
-                                arrow.fill.fore_color.rgb = template['accent']
-                                arrow.line.fill.background()
-                    
-                    # --- Comparison Layout ---
-                    elif layout_choice == "comparison":
-                        left_points = points[:2]
-                        right_points = points[2:4]
-                        
-                        divider = slide_obj.shapes.add_shape(
-                            MSO_SHAPE.ROUNDED_RECTANGLE,
-                            Inches(4.85), Inches(1.7), Inches(0.3), Inches(5)
-                        )
-                        divider.fill.solid()
-                        divider.fill.fore_color.rgb = template['accent']
-                        divider.line.fill.background()
-                        
-                        for i, point in enumerate(left_points):
-                            box = slide_obj.shapes.add_shape(
-                                MSO_SHAPE.ROUNDED_RECTANGLE,
-                                Inches(0.6), Inches(1.9 + i * 2.4), Inches(4), Inches(2.1)
-                            )
-                            box.fill.solid()
-                            box.fill.fore_color.rgb = RGBColor(255, 255, 255)
-                            box.line.color.rgb = template['primary']
-                            box.line.width = Pt(4)
-                            add_advanced_shadow(box, blur=8, distance=4, transparency=0.18)
-                            
-                            icon = slide_obj.shapes.add_shape(
-                                MSO_SHAPE.ROUNDED_RECTANGLE,
-                                Inches(0.9), Inches(2.1 + i * 2.4), Inches(0.5), Inches(0.5)
-                            )
-                            icon.fill.solid()
-                            icon.fill.fore_color.rgb = template['accent']
-                            icon.line.fill.background()
-                            
-                            icon_frame = icon.text_frame
-                            icon_frame.text = "◆"
-                            icon_p = icon_frame.paragraphs[0]
-                            icon_p.font.size = Pt(20)
-                            icon_p.font.color.rgb = RGBColor(255, 255, 255)
-                            icon_p.alignment = PP_ALIGN.CENTER
-                            icon_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                            
-                            frame = box.text_frame
-                            frame.word_wrap = True
-                            frame.margin_left = Inches(0.3)
-                            frame.margin_right = Inches(0.3)
-                            frame.margin_top = Inches(0.75)
-                            frame.margin_bottom = Inches(0.3)
-                            frame.text = point
-                            p = frame.paragraphs[0]
-                            p.font.size = Pt(16)
-                            p.font.color.rgb = template['text_primary']  # Dark text on white
-                            p.line_spacing = 1.3
-                            p.alignment = PP_ALIGN.CENTER
-                            frame.vertical_anchor = MSO_ANCHOR.TOP
-                        
-                        for i, point in enumerate(right_points):
-                            box = slide_obj.shapes.add_shape(
-                                MSO_SHAPE.ROUNDED_RECTANGLE,
-                                Inches(5.4), Inches(1.9 + i * 2.4), Inches(4), Inches(2.1)
-                            )
-                            box.fill.solid()
-                            box.fill.fore_color.rgb = RGBColor(255, 255, 255)
-                            box.line.color.rgb = template['primary']
-                            box.line.width = Pt(4)
-                            add_advanced_shadow(box, blur=8, distance=4, transparency=0.18)
-                            
-                            icon = slide_obj.shapes.add_shape(
-                                MSO_SHAPE.ROUNDED_RECTANGLE,
-                                Inches(8.5), Inches(2.1 + i * 2.4), Inches(0.5), Inches(0.5)
-                            )
-                            icon.fill.solid()
-                            icon.fill.fore_color.rgb = template['accent']
-                            icon.line.fill.background()
-                            
-                            icon_frame = icon.text_frame
-                            icon_frame.text = "◆"
-                            icon_p = icon_frame.paragraphs[0]
-                            icon_p.font.size = Pt(20)
-                            icon_p.font.color.rgb = RGBColor(255, 255, 255)
-                            icon_p.alignment = PP_ALIGN.CENTER
-                            icon_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                            
-                            frame = box.text_frame
-                            frame.word_wrap = True
-                            frame.margin_left = Inches(0.3)
-                            frame.margin_right = Inches(0.3)
-                            frame.margin_top = Inches(0.75)
-                            frame.margin_bottom = Inches(0.3)
-                            frame.text = point
-                            p = frame.paragraphs[0]
-                            p.font.size = Pt(16)
-                            p.font.color.rgb = template['text_primary']  # Dark text on white
-                            p.line_spacing = 1.3
-                            p.alignment = PP_ALIGN.CENTER
-                            frame.vertical_anchor = MSO_ANCHOR.TOP
-                    
-                    # --- Grid Layout ---
-                    elif layout_choice == "grid":
-                        positions = [
-                            (0.6, 1.8), (5.2, 1.8),
-                            (0.6, 4.5), (5.2, 4.5)
-                        ]
-                        
-                        for i, point in enumerate(points[:4]):
-                            x, y = positions[i]
-                            box = slide_obj.shapes.add_shape(
-                                MSO_SHAPE.ROUNDED_RECTANGLE,
-                                Inches(x), Inches(y), Inches(4.2), Inches(2.4)
-                            )
-                            box.fill.solid()
-                            box.fill.fore_color.rgb = RGBColor(255, 255, 255)
-                            box.line.color.rgb = template['accent']
-                            box.line.width = Pt(5)
-                            add_advanced_shadow(box, blur=10, distance=5, transparency=0.2)
-                            
-                            badge = slide_obj.shapes.add_shape(
-                                MSO_SHAPE.OVAL,
-                                Inches(x + 0.3), Inches(y + 0.3), Inches(0.6), Inches(0.6)
-                            )
-                            badge.fill.solid()
-                            badge.fill.fore_color.rgb = template['primary']
-                            badge.line.fill.background()
-                            
-                            badge_frame = badge.text_frame
-                            badge_frame.text = str(i + 1)
-                            badge_p = badge_frame.paragraphs[0]
-                            badge_p.font.size = Pt(24)
-                            badge_p.font.bold = True
-                            badge_p.font.color.rgb = RGBColor(255, 255, 255)
-                            badge_p.alignment = PP_ALIGN.CENTER
-                            badge_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                            
-                            frame = box.text_frame
-                            frame.word_wrap = True
-                            frame.margin_left = Inches(0.4)
-                            frame.margin_right = Inches(0.4)
-                            frame.margin_top = Inches(1.1)
-                            frame.text = point
-                            p = frame.paragraphs[0]
-                            p.font.size = Pt(17)
-                            p.font.color.rgb = template['text_primary']
-                            p.line_spacing = 1.3
-                            p.alignment = PP_ALIGN.CENTER
-                            frame.vertical_anchor = MSO_ANCHOR.TOP
-                    
-                    # --- Numbered Layout ---
-                    elif layout_choice == "numbered":
-                        for i, point in enumerate(points[:4]):
-                            y_pos = 1.8 + i * 1.35
-                            
-                            number_box = slide_obj.shapes.add_shape(
-                                MSO_SHAPE.ROUNDED_RECTANGLE,
-                                Inches(0.8), Inches(y_pos), Inches(1), Inches(1.2)
-                            )
-                            number_box.fill.solid()
-                            number_box.fill.fore_color.rgb = template['primary']
-                            number_box.line.fill.background()
-                            add_advanced_shadow(number_box, blur=8, distance=4, transparency=0.2)
-                            
-                            num_frame = number_box.text_frame
-                            num_frame.text = str(i + 1)
-                            num_p = num_frame.paragraphs[0]
-                            num_p.font.size = Pt(48)
-                            num_p.font.bold = True
-                            num_p.font.color.rgb = RGBColor(255, 255, 255)
-                            num_p.alignment = PP_ALIGN.CENTER
-                            num_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                            
-                            content_box = slide_obj.shapes.add_shape(
-                                MSO_SHAPE.ROUNDED_RECTANGLE,
-                                Inches(2), Inches(y_pos), Inches(7.2), Inches(1.2)
-                            )
-                            content_box.fill.solid()
-                            content_box.fill.fore_color.rgb = template['shape_fill']
-                            content_box.line.color.rgb = template['accent']
-                            content_box.line.width = Pt(4)
-                            add_advanced_shadow(content_box, blur=8, distance=4, transparency=0.18)
-                            
-                            content_frame = content_box.text_frame
-                            content_frame.word_wrap = True
-                            content_frame.margin_left = Inches(0.4)
-                            content_frame.margin_right = Inches(0.4)
-                            content_frame.margin_top = Inches(0.25)
-                            content_frame.text = point
-                            content_p = content_frame.paragraphs[0]
-                            content_p.font.size = Pt(19)
-                            content_p.font.color.rgb = template['shape_text']
-                            content_p.line_spacing = 1.4
-                            content_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                    
-                    # --- Highlight Layout ---
-                    elif layout_choice == "highlight":
-                        for i, point in enumerate(points[:4]):
-                            y_pos = 1.8 + i * 1.35
-                            
-                            box = slide_obj.shapes.add_shape(
-                                MSO_SHAPE.ROUNDED_RECTANGLE,
-                                Inches(1.2), Inches(y_pos), Inches(7.6), Inches(1.2)
-                            )
-                            box.fill.solid()
-                            box.fill.fore_color.rgb = RGBColor(255, 255, 255)  # Always white background
-                            box.line.color.rgb = template['primary']
-                            box.line.width = Pt(5)
-                            add_advanced_shadow(box, blur=10, distance=5, transparency=0.2)
-                            
-                            accent = slide_obj.shapes.add_shape(
-                                MSO_SHAPE.ROUNDED_RECTANGLE,
-                                Inches(1.3), Inches(y_pos + 0.2), Inches(0.15), Inches(0.8)
-                            )
-                            accent.fill.solid()
-                            accent.fill.fore_color.rgb = template['accent']
-                            accent.line.fill.background()
-                            
-                            frame = box.text_frame
-                            frame.word_wrap = True
-                            frame.margin_left = Inches(0.6)
-                            frame.margin_right = Inches(0.4)
-                            frame.margin_top = Inches(0.25)
-                            frame.text = point
-                            p = frame.paragraphs[0]
-                            p.font.size = Pt(19)
-                            p.font.color.rgb = template['text_primary']  # Dark text on white
-                            p.line_spacing = 1.4
-                            frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                    
-                    # --- Icon Based Layout ---
-                    elif layout_choice == "icon_based":
-                        icons = ["★", "●", "■", "▲"]
-                        
-                        for i, point in enumerate(points[:4]):
-                            y_pos = 1.8 + i * 1.35
-                            
-                            icon_circle = slide_obj.shapes.add_shape(
-                                MSO_SHAPE.OVAL,
-                                Inches(0.9), Inches(y_pos + 0.2), Inches(0.8), Inches(0.8)
-                            )
-                            icon_circle.fill.solid()
-                            icon_circle.fill.fore_color.rgb = template['accent']
-                            icon_circle.line.fill.background()
-                            add_advanced_shadow(icon_circle, blur=6, distance=3, transparency=0.2)
-                            
-                            icon_frame = icon_circle.text_frame
-                            icon_frame.text = icons[i]
-                            icon_p = icon_frame.paragraphs[0]
-                            icon_p.font.size = Pt(32)
-                            icon_p.font.bold = True
-                            icon_p.font.color.rgb = RGBColor(255, 255, 255)
-                            icon_p.alignment = PP_ALIGN.CENTER
-                            icon_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                            
-                            box = slide_obj.shapes.add_shape(
-                                MSO_SHAPE.ROUNDED_RECTANGLE,
-                                Inches(1.9), Inches(y_pos), Inches(7.3), Inches(1.2)
-                            )
-                            box.fill.solid()
-                            box.fill.fore_color.rgb = RGBColor(255, 255, 255)
-                            box.line.color.rgb = template['primary']
-                            box.line.width = Pt(4)
-                            add_advanced_shadow(box, blur=8, distance=4, transparency=0.18)
-                            
-                            frame = box.text_frame
-                            frame.word_wrap = True
-                            frame.margin_left = Inches(0.4)
-                            frame.margin_right = Inches(0.4)
-                            frame.margin_top = Inches(0.25)
-                            frame.text = point
-                            p = frame.paragraphs[0]
-                            p.font.size = Pt(19)
-                            p.font.color.rgb = template['text_primary']
-                            p.line_spacing = 1.4
-                            frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-
-            elif slide_type == "conclusion":
-                top_decoration = slide_obj.shapes.add_shape(
-                    MSO_SHAPE.ROUNDED_RECTANGLE,
-                    Inches(3), Inches(0.4), Inches(4), Inches(0.3)
-                )
-                top_decoration.fill.solid()
-                top_decoration.fill.fore_color.rgb = template['accent']
-                top_decoration.line.fill.background()
-                
-                title_box = slide_obj.shapes.add_shape(
-                    MSO_SHAPE.ROUNDED_RECTANGLE,
-                    Inches(2), Inches(0.8), Inches(6), Inches(1)
-                )
-                title_box.fill.solid()
-                title_box.fill.fore_color.rgb = template['primary']
-                title_box.line.fill.background()
-                add_advanced_shadow(title_box, blur=14, distance=7, transparency=0.25)
-                
-                title_frame = title_box.text_frame
-                title_frame.text = slide_data.get("title", "Xulosa")
-                title_frame.margin_left = Inches(0.5)
-                title_frame.margin_right = Inches(0.5)
-                title_p = title_frame.paragraphs[0]
-                title_p.font.size = Pt(42)
-                title_p.font.bold = True
-                title_p.font.color.rgb = RGBColor(255, 255, 255)  # White text on dark primary
-                title_p.alignment = PP_ALIGN.CENTER
-                title_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                
-                if slide_data.get("summary"):
-                    summary_box = slide_obj.shapes.add_shape(
-                        MSO_SHAPE.ROUNDED_RECTANGLE,
-                        Inches(1.5), Inches(2.1), Inches(7), Inches(1.4)
-                    )
-                    summary_box.fill.solid()
-                    summary_box.fill.fore_color.rgb = template['shape_fill']
-                    summary_box.line.color.rgb = template['accent']
-                    summary_box.line.width = Pt(4)
-                    add_advanced_shadow(summary_box, blur=10, distance=5, transparency=0.18)
-                    
-                    summary_frame = summary_box.text_frame
-                    summary_frame.word_wrap = True
-                    summary_frame.margin_left = Inches(0.5)
-                    summary_frame.margin_right = Inches(0.5)
-                    summary_frame.margin_top = Inches(0.3)
-                    summary_frame.margin_bottom = Inches(0.3)
-                    summary_frame.text = slide_data.get("summary", "")
-                    summary_p = summary_frame.paragraphs[0]
-                    summary_p.font.size = Pt(18)
-                    summary_p.font.color.rgb = template['shape_text']  # Proper contrast text
-                    summary_p.line_spacing = 1.5
-                    summary_p.alignment = PP_ALIGN.CENTER
-                    summary_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                
-                if slide_data.get("takeaways"):
-                    takeaways = slide_data.get("takeaways", [])
-                    
-                    if len(takeaways) >= 3:
-                        for i, takeaway in enumerate(takeaways[:3]):
-                            x_pos = 0.8 + i * 3
-                            
-                            card = slide_obj.shapes.add_shape(
-                                MSO_SHAPE.ROUNDED_RECTANGLE,
-                                Inches(x_pos), Inches(3.9), Inches(2.8), Inches(2.3)
-                            )
-                            card.fill.solid()
-                            card.fill.fore_color.rgb = RGBColor(255, 255, 255)
-                            card.line.color.rgb = template['primary']
-                            card.line.width = Pt(5)
-                            add_advanced_shadow(card, blur=10, distance=5, transparency=0.2)
-                            
-                            check = slide_obj.shapes.add_shape(
-                                MSO_SHAPE.OVAL,
-                                Inches(x_pos + 1.15), Inches(4.2), Inches(0.5), Inches(0.5)
-                            )
-                            check.fill.solid()
-                            check.fill.fore_color.rgb = template['accent']
-                            check.line.fill.background()
-                            
-                            check_frame = check.text_frame
-                            check_frame.text = "✓"
-                            check_p = check_frame.paragraphs[0]
-                            check_p.font.size = Pt(24)
-                            check_p.font.bold = True
-                            check_p.font.color.rgb = RGBColor(255, 255, 255)  # White checkmark on colored circle
-                            check_p.alignment = PP_ALIGN.CENTER
-                            check_frame.vertical_anchor = MSO_ANCHOR.MIDDLE
-                            
-                            card_frame = card.text_frame
-                            card_frame.word_wrap = True
-                            card_frame.margin_left = Inches(0.25)
-                            card_frame.margin_right = Inches(0.25)
-                            card_frame.margin_top = Inches(0.85)
-                            card_frame.margin_bottom = Inches(0.25)
-                            card_frame.text = takeaway
-                            card_p = card_frame.paragraphs[0]
-                            card_p.font.size = Pt(15)
-                            card_p.font.color.rgb = template['text_primary']  # Dark text on white card
-                            card_p.line_spacing = 1.3
-                            card_p.alignment = PP_ALIGN.CENTER
-                            card_frame.vertical_anchor = MSO_ANCHOR.TOP
+            
+                title = slide_data.get("title", "")
+                # Line breaks become extra paragraphs in python-pptx, which a single cloned run can't express
+                if PROTOTYPE_SLIDES and not any("\n" in str(text) or "\v" in str(text) for text in [title] + points[:4]):
+                    clone_content_slide(slide_obj, template, title, points, layout_choice)
+                else:
+                    draw_content_slide(slide_obj, template, title, points, layout_choice)
+            
+            elif slide_type in LAYOUT_PLANS:
+                apply_layout_plan(slide_obj, template, LAYOUT_PLANS[slide_type], slide_data)
+    
+    except Exception as e:
+        print(f"[v0] Error creating slide {idx + 1}: {e}")
+
+    # Added last so the picture takes a fresh shape id; add_slide_image sends it to the back
+    if image is not None:
+        add_slide_image(slide_obj, image)
+
+    return slide_obj
+
+def render_ppt_sync(content, template_name, images=None, seed=None):
+    """Render slide JSON with the named registry template and return the PPTX bytes
+
+    With a seed the layout choices are repeatable, so the same inputs give the same deck.
+    """
+    images = images or {}
+    rng = random.Random(seed) if seed is not None else random
+    print(f"[v0] Starting READABLE PPT creation with {len(content)} slides")
+    
+    # Workers share the registry, so only the template name crosses the process boundary
+    template = get_advanced_design_template(name=template_name)
+    prs = new_presentation(template)
+    print(f"[v0] Using READABLE design template: {template['name']} ({template['style']})")
+    
+    used_layouts = []
+    for idx, slide_data in enumerate(content):
+        render_slide(prs, template, idx, slide_data, used_layouts, images.get(idx), rng)
+
+    return save_presentation(prs)
+
+def render_ppt_stream_sync(queue, template_name):
+    """Render slides as they are put on queue and return the PPTX bytes once None arrives
+
+    Messages are ("slide", idx, slide_data) and ("image", idx, image_bytes); an image may
+    arrive before or after its slide, and slides may arrive out of order.
+    """
+    template = get_advanced_design_template(name=template_name)
+    prs = new_presentation(template)
+    print(f"[v0] Streaming READABLE PPT creation with template: {template['name']} ({template['style']})")
+    
+    used_layouts = []
+    slide_objs = {}
+    early_images = {}
+    while True:
+        message = queue.get()
+        if message is None:
+            break
+        kind, idx, payload = message
+        if kind == "slide":
+            slide_objs[idx] = render_slide(prs, template, idx, payload, used_layouts, early_images.pop(idx, None))
+        elif kind == "image":
+            if idx in slide_objs:
+                add_slide_image(slide_objs[idx], payload)
+            else:
+                early_images[idx] = payload
+
+    if not slide_objs:
+        return None
+    
+    # Regenerated slides arrive late; put every slide back at its index
+    order = {slide_obj.slide_id: idx for idx, slide_obj in slide_objs.items()}
+    sld_id_lst = prs.slides._sldIdLst
+    sld_ids = list(sld_id_lst)
+    for sld_id in sorted(sld_ids, key=lambda sld_id: order.get(sld_id.id, 0)):
+        sld_id_lst.remove(sld_id)
+        sld_id_lst.append(sld_id)
+    return save_presentation(prs)
+
+async def create_ppt_streaming(topic, num_slides, university, student_name, from_to, on_content=None):
+    """Stream slide content and render each slide as it closes, fetching its images alongside
+
+    on_content, if given, is called with the slides as soon as they are final, before the image
+    wait and the render finish. Returns (in-memory PPTX file, slides), or (None, slides) when no
+    slide came back.
+    """
+    loop = asyncio.get_running_loop()
+    template = get_advanced_design_template()
+    queue = get_render_manager().Queue()
+    render_future = loop.run_in_executor(get_stream_render_pool(), run_with_metrics, render_ppt_stream_sync, queue, template["name"])
+    
+    async def send(message):
+        await loop.run_in_executor(None, queue.put, message)
+    
+    async def send_image(idx, slide_data):
+        image = await fetch_slide_image(slide_data)
+        if image is not None:
+            await send(("image", idx, image))
+    
+    def start_image(idx, slide_data):
+        nonlocal image_deadline
+        if FAL_KEY and IMAGES_PER_SLIDE > 0 and slide_data.get("image_prompts"):
+            if image_deadline is None:
+                image_deadline = loop.time() + DECK_IMAGE_TIMEOUT
+            image_tasks.append(asyncio.ensure_future(send_image(idx, slide_data)))
+    
+    async def send_fixed(idx, slide_data):
+        slide_data = await fix_slide(topic, slide_data, university, student_name, from_to)
+        slots[idx] = slide_data
+        await send(("slide", idx, slide_data))
+        start_image(idx, slide_data)
+    
+    def slot_for(slide_type):
+        # Fixed deck positions: title, introduction, content..., conclusion
+        if slide_type == "content":
+            return next((idx for idx in range(2, num_slides - 1) if idx not in slots), None)
+        idx = {"title": 0, "introduction": 1, "conclusion": num_slides - 1}[slide_type]
+        return idx if idx not in slots else None
+    
+    async def add(slide_data):
+        slide_type = slide_type_of(slide_data)
+        if slide_type == "title":
+            slide_data = fill_title_slide(slide_data, topic, university, student_name, from_to)
+        idx = slot_for(slide_type)
+        if idx is None:
+            print(f"[v0] Dropping extra {slide_type} slide: {slide_data.get('title', '')}")
+            return
+        slots[idx] = slide_data
+        if validate_slide(slide_data):
+            # Regenerated off the stream so the slides behind it keep rendering
+            fix_tasks.append(asyncio.ensure_future(send_fixed(idx, slide_data)))
+            return
+        await send(("slide", idx, slide_data))
+        start_image(idx, slide_data)
+    
+    image_tasks = []
+    fix_tasks = []
+    image_deadline = None
+    slots = {}
+    try:
+        async for slide_data in stream_slide_content(topic, num_slides, university, student_name, from_to):
+            await add(slide_data)
+        
+        # The renderer orders slides by index, so whatever the stream missed can still be slotted in
+        received = [slots[idx] for idx in sorted(slots)]
+        if needs_completion(received, num_slides):
+            print(f"[v0] Stream came back short, requesting missing slides: {missing_slides(received, num_slides)}")
+            response = await request_completion(build_missing_slides_prompt(topic, received, num_slides), structured(SLIDES_RESPONSE_FORMAT))
+            missing = parse_slide_response(response) if response is not None else []
+            for slide_data in slide_dicts(missing) if isinstance(missing, list) else []:
+                await add(slide_data)
+        if slots and 0 not in slots:
+            await add({"type": "title"})
         
+        if fix_tasks:
+            await asyncio.gather(*fix_tasks)
+        if on_content is not None:
+            on_content([slots[idx] for idx in sorted(slots)])
+        if image_tasks:
+            _, pending = await asyncio.wait(image_tasks, timeout=max(0, image_deadline - loop.time()))
+            for task in pending:
+                task.cancel()
+            if pending:
+                print(f"[v0] Deck image deadline reached, {len(pending)} slides left without images")
+    finally:
+        for task in image_tasks + fix_tasks:
+            task.cancel()
+        await send(None)
+    
+    ppt_bytes, events = await render_future
+    stage_metrics.replay(events)
+    content = [slots[idx] for idx in sorted(slots)]
+    if ppt_bytes is None:
+        return None, content
+    print(f"[v0] READABLE presentation streamed successfully ({len(content)} slides)")
+    return BytesIO(ppt_bytes), content
+
+async def create_ppt(content):
+    """Render the deck in the render pool and return an in-memory PPTX file
+
+    Design and layouts are seeded from the content, so repeat requests (content cache hits with
+    the same title fields) produce the same deck and can reuse its Telegram upload.
+    """
+    seed = content_fingerprint(content)
+    template = get_advanced_design_template(seed=seed)
+    images = await fetch_deck_images(content)
+    
+    loop = asyncio.get_running_loop()
+    ppt_bytes, events = await loop.run_in_executor(get_render_pool(), run_with_metrics, render_ppt_sync, content, template["name"], images, seed)
+    stage_metrics.replay(events)
+    print(f"[v0] READABLE presentation created successfully")
+    return BytesIO(ppt_bytes)
+
+
+deck_generations = {}
+
+async def build_deck(topic, num_slides, university, student_name, from_to):
+    """Produce the deck from the content cache or a fresh generation; returns (PPTX file or None, slide count)
+
+    Identical requests arriving while a generation is in flight wait for it instead of starting
+    their own, then render the shared slides with their own title-slide fields.
+    """
+    cached_content = await run_blocking(content_cache_get, topic, num_slides)
+    if cached_content:
+        print(f"[v0] Content cache hit for '{topic}' ({num_slides} slides)")
+        ai_content = apply_title_fields(cached_content, university, student_name, from_to)
+        return await create_ppt(ai_content), len(ai_content)
+    
+    key = content_cache_key(topic, num_slides)
+    shared = deck_generations.get(key)
+    if shared is not None:
+        print(f"[v0] Joining in-flight generation for '{topic}' ({num_slides} slides)")
+        # Shielded so a follower giving up does not cancel the generation for everyone else
+        shared_content = await asyncio.shield(shared)
+        if not shared_content:
+            return None, 0
+        ai_content = apply_title_fields(shared_content, university, student_name, from_to)
+        return await create_ppt(ai_content), len(ai_content)
+    
+    shared = asyncio.get_running_loop().create_future()
+    deck_generations[key] = shared
+    ai_content = []
+    try:
+        print("[v0] Starting ADVANCED content generation...")
+        if STREAM_SLIDES and not use_planner(num_slides):
+            # Followers get the slides once the stream is done, not after this deck's images and render
+            ppt_file, ai_content = await create_ppt_streaming(topic, num_slides, university, student_name, from_to, shared.set_result)
+        else:
+            ai_content = await generate_slide_content(topic, num_slides, university, student_name, from_to)
+            # Followers can render as soon as the content exists
+            shared.set_result(ai_content)
+            ppt_file = None
+            if ai_content:
+                print(f"[v0] Content generated, creating ULTRA-MODERN ADVANCED PPT with {len(ai_content)} slides...")
+                ppt_file = await create_ppt(ai_content)
+    finally:
+        del deck_generations[key]
+        if not shared.done():
+            shared.set_result(ai_content)
+    
+    # Only complete decks are worth reusing; truncated ones would be served short forever
+    if ppt_file is not None and len(ai_content) == num_slides:
+        await run_blocking(content_cache_put, topic, num_slides, ai_content)
+    return ppt_file, len(ai_content)
+
+
+class Conversation:
+    """One user's answers so far; __slots__ keeps the many idle ones small"""
+    __slots__ = ("topic", "num_slides", "university", "student_name", "from_to", "updated")
+    FIELDS = ("topic", "num_slides", "university", "student_name", "from_to")
+
+    def __init__(self, updated=None, **fields):
+        for field in self.FIELDS:
+            setattr(self, field, fields.get(field))
+        self.updated = time.time() if updated is None else updated
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def next_state(self):
+        """Conversation state that asks for the first missing answer, or None when complete"""
+        for field, state in zip(self.FIELDS, (TOPIC, NUM_SLIDES, UNIVERSITY, STUDENT_NAME, FROM_TO)):
+            if getattr(self, field) is None:
+                return state
+        return None
+
+class ConversationStore:
+    """Per-user conversation records that expire after CONVERSATION_TTL of inactivity
+
+    With a database path every change is written through to SQLite and reloaded on start, so a
+    restart does not drop half-finished conversations. Writes go to a single writer thread, in
+    order, so handlers never wait on a commit.
+    """
+
+    def __init__(self, ttl, path=""):
+        self.ttl = ttl
+        self.path = path
+        self.records = {}
+        self.db = None
+        self.writer = None
+        self.sweeper = None
+        # Called with the user ids whose records the sweeper dropped
+        self.on_expire = None
+
+    def open(self):
+        """Connect to the database and restore stored conversations; called at startup, not import"""
+        if self.path and self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS conversations (user_id INTEGER PRIMARY KEY, data TEXT, updated REAL)")
+            self.db.commit()
+            self.load()
+            self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="conversations")
+
+    def load(self):
+        cutoff = time.time() - self.ttl
+        for user_id, data, updated in self.db.execute("SELECT user_id, data, updated FROM conversations WHERE updated >= ?", (cutoff,)):
+            self.records[user_id] = Conversation(updated=updated, **json.loads(data))
+        print(f"[v0] Restored {len(self.records)} conversations from {self.path}")
+
+    def expired(self, record, now):
+        return now - record.updated > self.ttl
+
+    def get(self, user_id):
+        record = self.records.get(user_id)
+        if record is not None and self.expired(record, time.time()):
+            self.discard(user_id)
+            return None
+        return record
+
+    def start(self, user_id):
+        record = Conversation()
+        self.records[user_id] = record
+        self.save(user_id, record)
+        return record
+
+    def update(self, user_id, **fields):
+        record = self.get(user_id) or Conversation()
+        for field, value in fields.items():
+            setattr(record, field, value)
+        record.updated = time.time()
+        self.records[user_id] = record
+        self.save(user_id, record)
+        return record
+
+    def pop(self, user_id):
+        record = self.get(user_id)
+        self.discard(user_id)
+        return record
+
+    def discard(self, user_id):
+        self.records.pop(user_id, None)
+        self.write("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+
+    def save(self, user_id, record):
+        # Serialised now, so later changes to record don't leak into this write
+        self.write(
+            "INSERT OR REPLACE INTO conversations (user_id, data, updated) VALUES (?, ?, ?)",
+            (user_id, json.dumps(record.as_dict(), ensure_ascii=False), record.updated)
+        )
+
+    def write(self, sql, params):
+        if self.writer is not None:
+            self.writer.submit(self.execute, sql, params)
+
+    def execute(self, sql, params):
+        try:
+            self.db.execute(sql, params)
+            self.db.commit()
         except Exception as e:
-            print(f"[v0] Error creating slide {idx + 1}: {e}")
+            print(f"[v0] Conversation store write error: {e}")
+
+    def sweep(self):
+        """Drop every expired conversation and return the user ids that went"""
+        now = time.time()
+        stale = [user_id for user_id, record in self.records.items() if self.expired(record, now)]
+        for user_id in stale:
+            del self.records[user_id]
+        self.write("DELETE FROM conversations WHERE updated < ?", (now - self.ttl,))
+        return stale
+
+    async def sweep_forever(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            swept = self.sweep()
+            if swept:
+                print(f"[v0] Expired {len(swept)} abandoned conversations ({len(self.records)} active)")
+                if self.on_expire is not None:
+                    self.on_expire(set(swept))
+
+    def start_sweeper(self, interval):
+        self.sweeper = asyncio.ensure_future(self.sweep_forever(interval))
 
-    print(f"[v0] Saving READABLE presentation to {filename}")
-    prs.save(filename)
-    print(f"[v0] READABLE presentation saved successfully")
-    return filename
+    def close(self):
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+            self.sweeper = None
+        if self.writer is not None:
+            # Let queued writes land before the connection goes
+            self.writer.shutdown(wait=True)
+            self.writer = None
+        if self.db is not None:
+            self.db.close()
+            self.db = None
 
+conversations = ConversationStore(CONVERSATION_TTL, CONVERSATION_DB)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    conversations.start(update.effective_user.id)
     await update.message.reply_text(
         "🎓 Assalomu alaykum! ULTRA-MODERN taqdimot yaratish uchun ma'lumotlar kerak.\n\n"
         "✨ 2025 ADVANCED DIZAYN XUSUSIYATLARI:\n"
@@ -1409,10 +2722,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def get_topic(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if user_id not in user_data_store:
-        user_data_store[user_id] = {}
-    
-    user_data_store[user_id]['topic'] = update.message.text
+    conversations.update(user_id, topic=update.message.text)
     await update.message.reply_text("Nechta slayd kerak? (masalan: 10)")
     return NUM_SLIDES
 
@@ -1420,10 +2730,11 @@ async def get_num_slides(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     try:
         num_slides = int(update.message.text.strip())
-        if num_slides < 4:
-            await update.message.reply_text("Kamida 4 ta slayd bo'lishi kerak (sarlavha, kirish, kontent, xulosa). Qaytadan kiriting:")
+        refusal = admission_error(num_slides)
+        if refusal is not None:
+            await update.message.reply_text(refusal)
             return NUM_SLIDES
-        user_data_store[user_id]['num_slides'] = num_slides
+        conversations.update(user_id, num_slides=num_slides)
     except:
         await update.message.reply_text("Iltimos, raqam kiriting (masalan: 10)")
         return NUM_SLIDES
@@ -1433,27 +2744,462 @@ async def get_num_slides(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def get_university(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user_data_store[user_id]['university'] = update.message.text
+    conversations.update(user_id, university=update.message.text)
     await update.message.reply_text("Talaba ismini kiriting:")
     return STUDENT_NAME
 
 async def get_student_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user_data_store[user_id]['student_name'] = update.message.text
+    conversations.update(user_id, student_name=update.message.text)
     await update.message.reply_text("O'qituvchi ismini kiriting (masalan: 'Aliyev A.A.'):")
     return FROM_TO
 
+class DeckJobQueue:
+    """Bounded FIFO of deck jobs served by a fixed number of worker tasks
+
+    Waiting users are told their position and get the message edited as the queue drains.
+    """
+
+    def __init__(self, workers, max_depth):
+        self.workers = workers
+        self.max_depth = max_depth
+        self.waiting = deque()
+        self.ready = None
+        self.busy = 0
+        self.tasks = []
+
+    def start(self, app=None):
+        self.ready = asyncio.Semaphore(0)
+        self.tasks = [asyncio.ensure_future(self.worker()) for _ in range(self.workers)]
+        print(f"[v0] Started {self.workers} deck workers (queue depth {self.max_depth})")
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def full(self):
+        return len(self.waiting) >= self.max_depth
+
+    async def submit(self, job):
+        """Queue job and return its position (0 = starting now), or None when the queue is full"""
+        if self.full():
+            stage_metrics.error("queue_wait")
+            return None
+        job["queued_at"] = time.perf_counter()
+        job["position"] = 0
+        job["position_message"] = None
+        self.waiting.append(job)
+        self.ready.release()
+        position = self.position(len(self.waiting) - 1)
+        if position > 0:
+            job["position"] = position
+            job["position_message"] = await job["message"].reply_text(queue_position_text(position))
+        return job["position"]
+
+    def position(self, index):
+        # Idle workers pick queued jobs up at their next await, so those jobs are not really waiting
+        return index + 1 - max(0, self.workers - self.busy)
+
+    async def worker(self):
+        while True:
+            await self.ready.acquire()
+            job = self.waiting.popleft()
+            self.busy += 1
+            stage_metrics.observe("queue_wait", time.perf_counter() - job["queued_at"])
+            if job["position_message"] is not None:
+                self.edit_position_message(job, "⏳ Navbatingiz keldi, taqdimot tayyorlanmoqda...")
+            self.announce_positions()
+            try:
+                await run_deck_job(job)
+            except Exception as e:
+                print(f"[v0] Deck job crashed: {e}")
+            finally:
+                self.busy -= 1
+
+    def announce_positions(self):
+        for index, job in enumerate(self.waiting):
+            position = self.position(index)
+            if position > 0 and job["position_message"] is not None and job["position"] != position:
+                job["position"] = position
+                self.edit_position_message(job, queue_position_text(position))
+
+    def edit_position_message(self, job, text):
+        # Edits run in the background but chained per job, so they land in order
+        job["edit_task"] = asyncio.ensure_future(edit_queue_message(job["position_message"], text, job.get("edit_task")))
+
+def queue_position_text(position):
+    return (
+        f"🕒 Siz navbatda #{position} o'rindasiz.\n"
+        f"Navbatingiz kelganda taqdimot tayyorlash avtomatik boshlanadi."
+    )
+
+async def reply_queue_full(message):
+    await message.reply_text(
+        "⚠️ Hozir so'rovlar juda ko'p, navbat to'lgan.\n"
+        "Iltimos, birozdan keyin /start buyrug'i bilan qaytadan urinib ko'ring."
+    )
+
+async def edit_queue_message(message, text, previous=None):
+    try:
+        if previous is not None:
+            await previous
+        await message.edit_text(text)
+    except Exception as e:
+        print(f"[v0] Could not update queue position: {e}")
+
+async def start_background_tasks(app=None):
+    conversations.open()
+    deck_queue.start(app)
+    conversations.start_sweeper(CONVERSATION_SWEEP_INTERVAL)
+
+async def run_deck_job(job):
+    """Build the deck for a dequeued job and deliver it to the user's chat"""
+    message = job["message"]
+    try:
+        with stage_metrics.track("deck"):
+            ppt_file, slide_count = await build_deck(
+                job['topic'], job['num_slides'], job['university'], job['student_name'], job['from_to']
+            )
+        await deliver_deck(message, ppt_file, slide_count)
+    except Exception as e:
+        print(f"[v0] Critical error in deck job: {e}")
+        await report_deck_error(message, e)
+
+async def deliver_deck(message, ppt_file, slide_count):
+    """Send the finished deck, or the generation error when there is none, as replies to message"""
+    if ppt_file is None:
+        await message.reply_text(
+            "⚠️ Taqdimot mazmunini yaratishda xatolik yuz berdi.\n"
+            "Iltimos, qaytadan urinib ko'ring yoki mavzuni o'zgartiring."
+        )
+        return
+    
+    print("[v0] Sending ADVANCED PPT file to user...")
+    await send_deck_file(message, ppt_file)
+    try:
+        await deck_ready_note(message, slide_count)
+    except Exception as e:
+        # The deck is already delivered; a lost note must not get it reported as failed or sent again
+        print(f"[v0] Could not send deck summary: {e}")
+
+async def deck_ready_note(message, slide_count):
+    await message.reply_text(
+        f"✅ ULTRA-MODERN ADVANCED taqdimot tayyor! {slide_count} ta slayd.\n\n"
+        f"🎨 2025 ADVANCED DIZAYN XUSUSIYATLARI:\n"
+        f"• 18 ta ultra-zamonaviy professional shablon\n"
+        f"• Minimalist, Dark Mode, Gradient uslublar\n"
+        f"• Retro-Futuristic va Cyberpunk dizaynlar\n"
+        f"• Asymmetric va split-screen layoutlar\n"
+        f"• Advanced shadows va depth effects\n"
+        f"• Geometric decorations\n"
+        f"• Enhanced typography hierarchy (52pt titles!)\n"
+        f"• Modern icon badges va indicators\n"
+        f"• Professional image framing\n"
+        f"• Ultra-yuqori kontrast - juda oson o'qiladi\n"
+        f"• Optimal spacing - hech narsa overlap qilmaydi\n"
+        f"• Modern color schemes va gradients\n"
+        f"• Side accents va decorative elements\n\n"
+        f"📥 Yuqoridagi faylni yuklab oling va ADVANCED taqdimotingizdan bahramand bo'ling!"
+    )
+
+async def send_deck_file(message, ppt_file):
+    """Upload the deck, or resend the file_id of an identical deck that was uploaded before"""
+    digest = pptx_content_hash(ppt_file.getvalue())
+    file_id = await run_blocking(telegram_file_get, digest)
+    with stage_metrics.track("telegram_upload"):
+        if file_id is not None:
+            try:
+                await message.reply_document(file_id)
+                print("[v0] Reused Telegram file_id for identical deck")
+                return
+            except Exception as e:
+                print(f"[v0] Cached file_id rejected, uploading again: {e}")
+        sent = await message.reply_document(ppt_file, filename="advanced_slides.pptx")
+    document = getattr(sent, "document", None)
+    if document is not None:
+        await run_blocking(telegram_file_put, digest, document.file_id)
+
+async def report_deck_error(message, error):
+    await message.reply_text(
+        f"⚠️ Taqdimot yaratishda xatolik yuz berdi.\n"
+        f"Xatolik: {str(error)}\n\n"
+        f"Iltimos, /start buyrug'i bilan qaytadan boshlang."
+    )
+
+class JobBroker:
+    """SQLite job table shared by the bot frontend and render worker processes on the same host
+
+    Jobs go queued -> running -> done/failed; the frontend delivers finished jobs and deletes them.
+    This is a single-host stand-in: WAL mode needs shared memory, so the database must sit on a
+    local disk, not a network filesystem. Calls block, so async callers go through run_blocking.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER, request TEXT, status TEXT, worker TEXT, "
+            "created REAL, claimed REAL, result BLOB, slide_count INTEGER, error TEXT, "
+            "attempts INTEGER DEFAULT 0, retry_at REAL DEFAULT 0)"
+        )
+        for column in ("attempts INTEGER DEFAULT 0", "retry_at REAL DEFAULT 0"):
+            try:
+                self.db.execute(f"ALTER TABLE jobs ADD COLUMN {column}")
+            except sqlite3.OperationalError:
+                pass  # already there
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+        self.lock = threading.Lock()
+
+    def enqueue(self, chat_id, request):
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT INTO jobs (chat_id, request, status, created) VALUES (?, ?, 'queued', ?)",
+                (chat_id, json.dumps(request, ensure_ascii=False), time.time())
+            )
+            return cursor.lastrowid
+
+    def depth(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def positions(self):
+        """{job id: 1-based position} for every queued job"""
+        with self.lock:
+            rows = self.db.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY id").fetchall()
+        return {job_id: position for position, (job_id,) in enumerate(rows, start=1)}
+
+    def claim(self, worker):
+        """Atomically take the oldest queued job, re-queueing ones whose worker went silent"""
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute(
+                    "UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND claimed < ?",
+                    (now - BROKER_JOB_TIMEOUT,)
+                )
+                row = self.db.execute("SELECT id, request FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+                if row is not None:
+                    self.db.execute("UPDATE jobs SET status = 'running', worker = ?, claimed = ? WHERE id = ?", (worker, now, row[0]))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def finish(self, job_id, ppt_bytes, slide_count):
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET status = 'done', result = ?, slide_count = ? WHERE id = ?",
+                (ppt_bytes, slide_count, job_id)
+            )
+
+    def fail(self, job_id, error):
+        with self.lock:
+            self.db.execute("UPDATE jobs SET status = 'failed', error = ? WHERE id = ?", (error, job_id))
+
+    def finished(self):
+        """Finished jobs whose delivery is due, oldest first, without their decks (see result)"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT id, chat_id, status, slide_count, error FROM jobs "
+                "WHERE status IN ('done', 'failed') AND retry_at <= ? ORDER BY id",
+                (time.time(),)
+            ).fetchall()
+
+    def result(self, job_id):
+        with self.lock:
+            row = self.db.execute("SELECT result FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def postpone(self, job_id, backoff):
+        """Count a failed delivery and hold the job back, doubling backoff per attempt; returns the attempt count"""
+        with self.lock:
+            attempts = self.db.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()[0] + 1
+            retry_at = time.time() + backoff * 2 ** min(attempts - 1, 8)
+            self.db.execute("UPDATE jobs SET attempts = ?, retry_at = ? WHERE id = ?", (attempts, retry_at, job_id))
+        return attempts
+
+    def delete(self, job_id):
+        with self.lock:
+            self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def close(self):
+        self.db.close()
+
+class ChatReplies:
+    """reply_text/reply_document for a chat id, so broker results go through the normal delivery code"""
+
+    def __init__(self, bot, chat_id):
+        self.bot = bot
+        self.chat_id = chat_id
+
+    async def reply_text(self, text):
+        return await self.bot.send_message(self.chat_id, text)
+
+    async def reply_document(self, document, filename=None):
+        return await self.bot.send_document(self.chat_id, document, filename=filename)
+
+class BrokerJobQueue:
+    """Frontend side of the broker: enqueue validated jobs, deliver results and keep positions current
+
+    Same interface as DeckJobQueue, so the handlers don't care which one is in use.
+    """
+
+    def __init__(self, path, max_depth, poll_interval):
+        self.path = path
+        self.broker = None
+        self.max_depth = max_depth
+        self.poll_interval = poll_interval
+        self.waiting = {}
+        # Queued job count as of the last poll, so full() needs no database call on the event loop
+        self.queued = 0
+        self.task = None
+
+    def start(self, app=None):
+        self.broker = JobBroker(self.path)
+        self.task = asyncio.ensure_future(self.poll(app.bot))
+        print(f"[v0] Sending deck jobs to broker {self.path}")
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.broker is not None:
+            self.broker.close()
+            self.broker = None
+
+    def full(self):
+        return self.queued >= self.max_depth
+
+    async def submit(self, job):
+        self.queued = await run_blocking(self.broker.depth)
+        if self.full():
+            stage_metrics.error("queue_wait")
+            return None
+        message = job["message"]
+        request = {field: job[field] for field in Conversation.FIELDS}
+        job_id = await run_blocking(self.broker.enqueue, message.chat_id, request)
+        position = (await run_blocking(self.broker.positions)).get(job_id, 0)
+        self.queued = max(self.queued + 1, position)
+        job["queued_at"] = time.perf_counter()
+        job["position"] = position
+        job["position_message"] = await message.reply_text(queue_position_text(position))
+        self.waiting[job_id] = job
+        return position
+
+    async def poll(self, bot):
+        while True:
+            try:
+                await self.deliver_finished(bot)
+                await self.announce_positions()
+            except Exception as e:
+                print(f"[v0] Broker poll error: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def deliver_finished(self, bot):
+        for job_id, chat_id, status, slide_count, error in await run_blocking(self.broker.finished):
+            job = self.waiting.get(job_id)
+            message = job["message"] if job is not None else ChatReplies(bot, chat_id)
+            try:
+                if status == "done":
+                    result = await run_blocking(self.broker.result, job_id)
+                    await deliver_deck(message, BytesIO(result) if result is not None else None, slide_count)
+                else:
+                    await report_deck_error(message, error)
+            except (Forbidden, BadRequest) as e:
+                # Blocked bot or deleted chat: retrying will not help
+                print(f"[v0] Dropping broker job {job_id}, chat {chat_id} unreachable: {e}")
+            except Exception as e:
+                # deliver_deck only raises before the deck went out, so a retry never sends it twice
+                attempts = await run_blocking(self.broker.postpone, job_id, self.poll_interval)
+                if attempts < BROKER_DELIVERY_ATTEMPTS:
+                    print(f"[v0] Delivery of broker job {job_id} failed (attempt {attempts}), retrying later: {e}")
+                    continue
+                print(f"[v0] Giving up on broker job {job_id} after {attempts} delivery attempts: {e}")
+            self.waiting.pop(job_id, None)
+            await run_blocking(self.broker.delete, job_id)
+
+    async def announce_positions(self):
+        positions = await run_blocking(self.broker.positions)
+        self.queued = len(positions)
+        for job_id, job in self.waiting.items():
+            position = positions.get(job_id, 0)
+            if position == job["position"]:
+                continue
+            job["position"] = position
+            if position > 0:
+                text = queue_position_text(position)
+            else:
+                stage_metrics.observe("queue_wait", time.perf_counter() - job["queued_at"])
+                text = "⏳ Navbatingiz keldi, taqdimot tayyorlanmoqda..."
+            job["edit_task"] = asyncio.ensure_future(edit_queue_message(job["position_message"], text, job.get("edit_task")))
+
+deck_queue = BrokerJobQueue(DECK_BROKER, JOB_QUEUE_DEPTH, BROKER_POLL_INTERVAL) if DECK_BROKER else DeckJobQueue(JOB_WORKERS, JOB_QUEUE_DEPTH)
+
+async def run_broker_worker():
+    """Render worker: claim broker jobs, build the decks and post the results back to the broker"""
+    broker = JobBroker(DECK_BROKER)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    print(f"[v0] Render worker {worker} serving {DECK_BROKER} with {JOB_WORKERS} slots")
+    
+    async def run_job(job_id, request):
+        try:
+            with stage_metrics.track("deck"):
+                ppt_file, slide_count = await build_deck(
+                    request['topic'], request['num_slides'], request['university'], request['student_name'], request['from_to']
+                )
+            await run_blocking(broker.finish, job_id, ppt_file.getvalue() if ppt_file is not None else None, slide_count)
+        except Exception as e:
+            print(f"[v0] Critical error in deck job {job_id}: {e}")
+            await run_blocking(broker.fail, job_id, str(e))
+    
+    async def slot():
+        while True:
+            try:
+                claimed = await run_blocking(broker.claim, worker)
+                if claimed is not None:
+                    await run_job(*claimed)
+                    continue
+            except Exception as e:
+                # e.g. "database is locked" while another worker writes a large result; a job left
+                # running is re-queued by claim once BROKER_JOB_TIMEOUT passes
+                print(f"[v0] Broker error in worker slot: {e}")
+            await asyncio.sleep(BROKER_POLL_INTERVAL)
+    
+    start_metrics_server()
+    try:
+        await asyncio.gather(*(slot() for _ in range(JOB_WORKERS)))
+    finally:
+        broker.close()
+        await shutdown_pools()
+
 async def get_from_to(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user_data_store[user_id]['from_to'] = update.message.text
+    conversations.update(user_id, from_to=update.message.text)
     
-    data = user_data_store[user_id]
+    record = conversations.pop(user_id)
+    if record.next_state() is not None:
+        await update.message.reply_text(
+            "⌛ Suhbat muddati tugagan, ba'zi ma'lumotlar saqlanmagan.\n"
+            "Iltimos, /start buyrug'i bilan qaytadan boshlang."
+        )
+        return ConversationHandler.END
+    data = record.as_dict()
     topic = data['topic']
     num_slides = data['num_slides']
     university = data['university']
     student_name = data['student_name']
     from_to = data['from_to']
     
+    if deck_queue.full():
+        await reply_queue_full(update.message)
+        return ConversationHandler.END
+    
     await update.message.reply_text(
         f"⏳ ULTRA-MODERN ADVANCED taqdimot tayyorlanmoqda...\n\n"
         f"📚 Mavzu: {topic}\n"
@@ -1464,68 +3210,50 @@ async def get_from_to(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"🎨 2025 ADVANCED DIZAYN - professional, zamonaviy, ultra-modern!\n"
         f"Iltimos, kuting..."
     )
-
-    try:
-        print("[v0] Starting ADVANCED content generation...")
-        ai_content = await generate_slide_content(topic, num_slides, university, student_name, from_to)
-
-        if not ai_content or len(ai_content) == 0:
-            await update.message.reply_text(
-                "⚠️ Taqdimot mazmunini yaratishda xatolik yuz berdi.\n"
-                "Iltimos, qaytadan urinib ko'ring yoki mavzuni o'zgartiring."
-            )
-            return ConversationHandler.END
-
-        print(f"[v0] Content generated, creating ULTRA-MODERN ADVANCED PPT with {len(ai_content)} slides...")
-        ppt_file = await create_ppt(ai_content, "advanced_slides.pptx")
-        
-        print("[v0] Sending ADVANCED PPT file to user...")
-        await update.message.reply_document(open(ppt_file, "rb"))
-        await update.message.reply_text(
-            f"✅ ULTRA-MODERN ADVANCED taqdimot tayyor! {len(ai_content)} ta slayd.\n\n"
-            f"🎨 2025 ADVANCED DIZAYN XUSUSIYATLARI:\n"
-            f"• 18 ta ultra-zamonaviy professional shablon\n"
-            f"• Minimalist, Dark Mode, Gradient uslublar\n"
-            f"• Retro-Futuristic va Cyberpunk dizaynlar\n"
-            f"• Asymmetric va split-screen layoutlar\n"
-            f"• Advanced shadows va depth effects\n"
-            f"• Geometric decorations\n"
-            f"• Enhanced typography hierarchy (52pt titles!)\n"
-            f"• Modern icon badges va indicators\n"
-            f"• Professional image framing\n"
-            f"• Ultra-yuqori kontrast - juda oson o'qiladi\n"
-            f"• Optimal spacing - hech narsa overlap qilmaydi\n"
-            f"• Modern color schemes va gradients\n"
-            f"• Side accents va decorative elements\n\n"
-            f"📥 Yuqoridagi faylni yuklab oling va ADVANCED taqdimotingizdan bahramand bo'ling!"
-        )
-        
-        del user_data_store[user_id]
-        
-    except Exception as e:
-        print(f"[v0] Critical error in get_from_to: {e}")
-        await update.message.reply_text(
-            f"⚠️ Taqdimot yaratishda xatolik yuz berdi.\n"
-            f"Xatolik: {str(e)}\n\n"
-            f"Iltimos, /start buyrug'i bilan qaytadan boshlang."
-        )
-        if user_id in user_data_store:
-            del user_data_store[user_id]
     
+    if await deck_queue.submit({**data, "message": update.message}) is None:
+        await reply_queue_full(update.message)
     return ConversationHandler.END
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ Bekor qilindi. /start buyrug'i bilan qaytadan boshlang.")
-    user_id = update.effective_user.id
-    if user_id in user_data_store:
-        del user_data_store[user_id]
+    conversations.discard(update.effective_user.id)
     return ConversationHandler.END
 
+async def resume_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Entry point for a stored conversation the handler no longer tracks, e.g. after a restart"""
+    record = conversations.get(update.effective_user.id)
+    if record is None or record.next_state() is None:
+        return ConversationHandler.END
+    handler = {
+        TOPIC: get_topic,
+        NUM_SLIDES: get_num_slides,
+        UNIVERSITY: get_university,
+        STUDENT_NAME: get_student_name,
+        FROM_TO: get_from_to,
+    }[record.next_state()]
+    return await handler(update, context)
+
 def main():
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    if sys.argv[1:] == ["worker"]:
+        if not DECK_BROKER:
+            raise SystemExit("The render worker needs DECK_BROKER pointing at the broker database")
+        asyncio.run(run_broker_worker())
+        return
+    
+    app = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(start_background_tasks)
+        .post_shutdown(shutdown_pools)
+        .build()
+    )
     
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
+        entry_points=[
+            CommandHandler("start", start),
+            MessageHandler(filters.TEXT & ~filters.COMMAND, resume_conversation),
+        ],
         states={
             TOPIC: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_topic)],
             NUM_SLIDES: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_num_slides)],
@@ -1537,7 +3265,43 @@ def main():
     )
     
     app.add_handler(conv_handler)
-    app.run_polling()
+    conversations.on_expire = lambda user_ids: forget_conversations(conv_handler, user_ids)
+    start_metrics_server()
+    if BOT_MODE == "webhook":
+        run_webhook(app)
+    else:
+        app.run_polling()
+
+def forget_conversations(handler, user_ids):
+    """Drop the handler's state for users whose stored conversation expired
+
+    ConversationHandler keeps a key until the conversation reaches END, and its own
+    conversation_timeout needs the job-queue extra, so the sweeper clears abandoned keys here.
+    """
+    stale = [key for key in handler._conversations if key[-1] in user_ids]
+    for key in stale:
+        del handler._conversations[key]
+
+def run_webhook(app):
+    """Receive updates pushed by Telegram, typically behind a local reverse proxy
+
+    WEBHOOK_URL is the public base URL the proxy forwards to WEBHOOK_LISTEN:WEBHOOK_PORT.
+    Instances sharing a bot token must share WEBHOOK_SECRET, since Telegram keeps only one.
+    Needs the webhooks extra: pip install "python-telegram-bot[webhooks]".
+    """
+    if not WEBHOOK_URL:
+        raise SystemExit("BOT_MODE=webhook needs WEBHOOK_URL")
+    if not WEBHOOK_SECRET:
+        raise SystemExit("BOT_MODE=webhook needs WEBHOOK_SECRET, shared by every instance")
+    print(f"[v0] Serving webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+    app.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
 
 if __name__ == "__main__":
     main()